@@ -1,6 +1,8 @@
 from flask import Flask, request
+import requests
 
 user_agent = 'osm-wikidata/0.1 (https://github.com/EdwardBetts/osm-wikidata; edward@4angle.com)'
+api_session = None
 
 class MatcherFlask(Flask):
     def log_exception(self, exc_info):
@@ -30,3 +32,14 @@ URL:                  %s
 
 def user_agent_headers():
     return {'User-Agent': user_agent}
+
+def get_api_session():
+    '''Session shared by the Wikidata and Wikipedia API calls so they reuse
+    connections.'''
+    global api_session
+    if api_session is None:
+        api_session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=16)
+        api_session.mount('https://', adapter)
+        api_session.headers.update(user_agent_headers())
+    return api_session
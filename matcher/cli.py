@@ -1,5 +1,5 @@
 from .view import app, get_top_existing
-from .model import Changeset, get_bad
+from .model import Changeset, Item, get_bad
 from .place import Place
 from . import database, mail, matcher, nominatim
 from datetime import datetime, timedelta
@@ -232,7 +232,9 @@ def refresh_address():
 
 @app.cli.command()
 @click.argument('place_identifier')
-def run_matcher(place_identifier):
+@click.option('--workers', type=int, default=1,
+              help='processes to use for name matching')
+def run_matcher(place_identifier, workers):
     app.config.from_object('config.default')
     database.init_app(app)
 
@@ -247,7 +249,7 @@ def run_matcher(place_identifier):
     print(place.state)
 
     print('do match')
-    place.do_match()
+    place.do_match(workers=workers)
     print(place.state, place.display_name)
     print('https://osm.wikidata.link/candidates/{place.osm_type}/{place.osm_id}'.format(place=place))
 
@@ -272,3 +274,53 @@ def show_chunks(place_identifier, chunk_count):
         pprint([i['bbox'] for i in place.chunk4()])
     if chunk_count == 3:
         pprint([i['bbox'] for i in place.chunk9()])
+
+@app.cli.command()
+@click.argument('place_identifier')
+def benchmark_matcher_sql(place_identifier):
+    ''' Compare planning time of the prepared matcher query with plain SQL. '''
+    app.config.from_object('config.default')
+    database.init_app(app)
+
+    if place_identifier.isdigit():
+        place = Place.query.get(place_identifier)
+    else:
+        osm_type, osm_id = place_identifier.split('/')
+        place = Place.query.filter_by(osm_type=osm_type, osm_id=osm_id).one()
+
+    print(place.display_name)
+
+    conn = database.session.bind.raw_connection()
+    cur = conn.cursor()
+
+    plain_sql = matcher.item_query_sql(place.prefix, {p: '%({})s'.format(p)
+                                                      for p in matcher.item_query_params})
+    name = matcher.prepare_item_query(cur, place.prefix)
+    prepared_sql = matcher.execute_item_query_sql(name)
+
+    totals = {'plain': [0, 0], 'prepared': [0, 0]}
+    item_count = 0
+    items = place.items.filter(Item.entity.isnot(None)).order_by(Item.item_id)
+    for item in items:
+        if not item.tags:
+            continue
+        item_count += 1
+        args = matcher.item_query_args(item)
+        queries = [('plain', plain_sql), ('prepared', prepared_sql)]
+        if item_count % 2:  # alternate which query runs first with warm caches
+            queries.reverse()
+        for label, sql in queries:
+            cur.execute('explain (analyze, format json) ' + sql, args)
+            plan = cur.fetchone()[0][0]
+            totals[label][0] += plan['Planning Time']
+            totals[label][1] += plan['Execution Time']
+
+    conn.close()
+
+    print('{} items'.format(item_count))
+    rows = [(label, planning, execution, planning + execution)
+            for label, (planning, execution) in totals.items()]
+    print(tabulate(rows,
+                   headers=['query', 'planning ms', 'execution ms', 'total ms'],
+                   tablefmt='simple',
+                   floatfmt='.1f'))
@@ -2,9 +2,14 @@ from sqlalchemy import create_engine, text
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.engine import reflection
 from social.apps.flask_app.default.models import init_social
+from time import time
 
 session = scoped_session(sessionmaker())
 
+osm_table_types = ('point', 'line', 'polygon')
+table_cache_ttl = 10  # seconds
+table_cache = {}
+
 def init_db(db_url):
     session.configure(bind=get_engine(db_url))
 
@@ -14,6 +19,45 @@ def get_engine(db_url, echo=False):
 def get_tables():
     return reflection.Inspector.from_engine(session.bind).get_table_names()
 
+def place_tables_exist(prefix):
+    '''True if the point, line and polygon tables for a place all exist.
+
+    Results are cached for a few seconds, functions here that create or drop
+    tables clear the cache.'''
+    now = time()
+    cached = table_cache.get(prefix)
+    if cached and cached[1] > now:
+        return cached[0]
+
+    names = {'t{}'.format(num): '{}_{}'.format(prefix, t)
+             for num, t in enumerate(osm_table_types)}
+    sql = 'select ' + ' and '.join('to_regclass(:{}) is not null'.format(k) for k in names)
+    exist = bool(session.bind.execute(text(sql), **names).scalar())
+    table_cache[prefix] = (exist, now + table_cache_ttl)
+    return exist
+
+def invalidate_table_cache(prefix=None):
+    if prefix is None:
+        table_cache.clear()
+    else:
+        table_cache.pop(prefix, None)
+
+def get_place_tables(prefix):
+    '''Names of every table that belongs to a place, including osm2pgsql slim
+    tables, found with one catalog query.'''
+    pattern = prefix.replace('_', '\\_') + '\\_%'
+    sql = '''
+select relname from pg_class
+where relkind in ('r', 'p') and relname like :pattern and pg_table_is_visible(oid)'''
+    return [row[0] for row in session.bind.execute(text(sql), pattern=pattern)]
+
+def drop_place_tables(prefix):
+    engine = session.bind
+    for t in get_place_tables(prefix):
+        engine.execute('drop table if exists {}'.format(t))
+    engine.execute('commit')
+    invalidate_table_cache(prefix)
+
 def init_app(app, echo=False):
     db_url = app.config['DB_URL']
     session.configure(bind=get_engine(db_url, echo=echo))
@@ -0,0 +1,228 @@
+from lxml import etree
+from io import StringIO
+import math
+
+# Load small Overpass extracts into PostGIS without running osm2pgsql. The
+# tables have the columns the matcher uses from the osm2pgsql tables:
+# osm_id, name, tags (hstore), way (EPSG:3857) and way_area for polygons.
+
+default_max_elements = 50000
+mercator_radius = 6378137
+max_lat = 85.0511287798
+
+polygon_keys = {'aeroway', 'amenity', 'area', 'building', 'harbour', 'historic',
+                'landuse', 'leisure', 'man_made', 'military', 'natural', 'office',
+                'place', 'power', 'public_transport', 'shop', 'sport', 'tourism',
+                'water', 'waterway', 'wetland', 'abandoned:aeroway',
+                'abandoned:amenity', 'abandoned:building', 'abandoned:landuse',
+                'abandoned:power', 'area:highway'}
+
+osm_tables = ('point', 'line', 'polygon')
+
+relation_tables = {'multipolygon': 'polygon', 'boundary': 'polygon', 'route': 'line'}
+
+create_table_sql = {
+    'point': 'create table {} (osm_id bigint, name text, tags hstore, way geometry(Point, 3857))',
+    'line': 'create table {} (osm_id bigint, name text, tags hstore, way geometry(Geometry, 3857))',
+    'polygon': ('create table {} (osm_id bigint, name text, tags hstore, '
+                'way geometry(Geometry, 3857), way_area real)'),
+}
+
+def read_osm_file(filename, max_elements=None):
+    '''Parse an OSM XML file into dicts of nodes, ways and relations.
+
+    Returns None if the file has more than max_elements elements.'''
+    nodes, ways, relations = {}, {}, {}
+    count = 0
+    for event, element in etree.iterparse(filename, tag=('node', 'way', 'relation')):
+        count += 1
+        if max_elements and count > max_elements:
+            return
+
+        osm_id = int(element.get('id'))
+        tags = {tag.get('k'): tag.get('v') for tag in element.iterchildren('tag')}
+        if element.tag == 'node':
+            nodes[osm_id] = (float(element.get('lon')), float(element.get('lat')), tags)
+        elif element.tag == 'way':
+            refs = [int(nd.get('ref')) for nd in element.iterchildren('nd')]
+            ways[osm_id] = (refs, tags)
+        else:
+            members = [(m.get('type'), int(m.get('ref')), m.get('role'))
+                       for m in element.iterchildren('member')]
+            relations[osm_id] = (members, tags)
+
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+    return nodes, ways, relations
+
+def mercator(lon, lat):
+    lat = max(min(lat, max_lat), -max_lat)
+    x = math.radians(lon) * mercator_radius
+    y = math.log(math.tan(math.pi / 4 + math.radians(lat) / 2)) * mercator_radius
+    return (x, y)
+
+def coords_wkt(points):
+    return '(' + ','.join('{:.2f} {:.2f}'.format(x, y) for x, y in points) + ')'
+
+def is_polygon(tags):
+    if tags.get('area') == 'no':
+        return False
+    return any(key in polygon_keys for key in tags)
+
+def osm_rows(nodes, ways, relations):
+    '''Rows of (osm_id, tags, WKT) for the point, line and polygon tables,
+    using the osm2pgsql convention of negative ids for relations.
+
+    Relation polygons are stored as their member ways and built with
+    ST_BuildArea once loaded.'''
+    rows = {'point': [], 'line': [], 'polygon': []}
+    coords = {}
+    for osm_id, (lon, lat, tags) in nodes.items():
+        coords[osm_id] = mercator(lon, lat)
+        if tags:
+            rows['point'].append((osm_id, tags, 'POINT({:.2f} {:.2f})'.format(*coords[osm_id])))
+
+    way_points = {osm_id: [coords[ref] for ref in refs if ref in coords]
+                  for osm_id, (refs, tags) in ways.items()}
+
+    for osm_id, (refs, tags) in ways.items():
+        if not tags:
+            continue
+        points = way_points[osm_id]
+        closed = len(refs) > 3 and refs[0] == refs[-1] and len(points) == len(refs)
+        if closed and is_polygon(tags):
+            rows['polygon'].append((osm_id, tags, 'POLYGON(' + coords_wkt(points) + ')'))
+        elif len(points) > 1:
+            rows['line'].append((osm_id, tags, 'LINESTRING' + coords_wkt(points)))
+
+    for osm_id, (members, tags) in relations.items():
+        table = relation_tables.get(tags.get('type'))
+        if not table or not set(tags) - {'type'}:
+            continue
+        lines = [way_points[ref] for member_type, ref, role in members
+                 if member_type == 'way' and len(way_points.get(ref, [])) > 1]
+        if not lines:
+            continue
+        wkt = 'MULTILINESTRING(' + ','.join(coords_wkt(line) for line in lines) + ')'
+        rows[table].append((-osm_id, tags, wkt))
+
+    return rows
+
+def escape_hstore(s):
+    return '"' + s.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def hstore_literal(tags):
+    return ','.join('{}=>{}'.format(escape_hstore(k), escape_hstore(v))
+                    for k, v in tags.items())
+
+def copy_value(value):
+    if value is None:
+        return '\\N'
+    return (str(value).replace('\\', '\\\\')
+                      .replace('\t', '\\t')
+                      .replace('\n', '\\n')
+                      .replace('\r', '\\r'))
+
+def copy_data(rows):
+    '''Rows in the text format read by COPY.'''
+    lines = []
+    for osm_id, tags, wkt in rows:
+        values = (osm_id, tags.get('name'), hstore_literal(tags), 'SRID=3857;' + wkt)
+        lines.append('\t'.join(copy_value(v) for v in values) + '\n')
+    return StringIO(''.join(lines))
+
+def load_osm(conn, prefix, nodes, ways, relations):
+    '''Replace the point, line and polygon tables for prefix.'''
+    cur = conn.cursor()
+    for table, rows in osm_rows(nodes, ways, relations).items():
+        name = '{}_{}'.format(prefix, table)
+        cur.execute('drop table if exists {}'.format(name))
+        cur.execute(create_table_sql[table].format(name))
+        sql = 'copy {} (osm_id, name, tags, way) from stdin'.format(name)
+        cur.copy_expert(sql, copy_data(rows))
+
+    polygon = prefix + '_polygon'
+    cur.execute('update {} set way = ST_BuildArea(way) where osm_id < 0'.format(polygon))
+    cur.execute('delete from {} where way is null or ST_IsEmpty(way)'.format(polygon))
+    cur.execute('update {} set way_area = ST_Area(way)'.format(polygon))
+
+    for table in osm_tables:
+        name = '{}_{}'.format(prefix, table)
+        cur.execute('create index on {} using gist (way)'.format(name))
+        cur.execute('analyze {}'.format(name))
+    conn.commit()
+
+# With OSM_PARTITIONS set the tables for each place become partitions of
+# shared osm_point, osm_line and osm_polygon tables, list partitioned by
+# place_id. A partition keeps the osm_<place_id>_<type> name so the matcher
+# queries it directly and only reads one place.
+#
+# Attaching doesn't copy any rows. The extra columns are dropped and the
+# place_id column is added with a constant default, both only change the
+# catalog. The parent tables use an unconstrained geometry type so changing
+# the type of way doesn't rewrite the table, and the only parent index is the
+# gist index on way, which the loaded tables already have.
+#
+# Each table is read once, to check the partition bound. This happens when
+# the check constraint is added, which only locks the place table, so the
+# attach that locks the parent table doesn't need to scan.
+
+def partition_columns(table):
+    return ['osm_id', 'name', 'tags', 'way'] + (['way_area'] if table == 'polygon' else [])
+
+def create_parent_tables(cur):
+    for table in osm_tables:
+        way_area = ', way_area real' if table == 'polygon' else ''
+        cur.execute('create table if not exists osm_{} (place_id integer not null, '
+                    'osm_id bigint, name text, tags hstore, way geometry{}) '
+                    'partition by list (place_id)'.format(table, way_area))
+        cur.execute('create index if not exists osm_{0}_way_idx on osm_{0} '
+                    'using gist (way)'.format(table))
+
+def table_columns(cur, name):
+    cur.execute('select attname from pg_attribute where attrelid = %s::regclass '
+                'and attnum > 0 and not attisdropped', (name,))
+    return [row[0] for row in cur.fetchall()]
+
+def partition_parent(cur, name):
+    cur.execute('select inhparent::regclass::text from pg_inherits '
+                'where inhrelid = to_regclass(%s)', (name,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+def attach_place_tables(conn, place_id, prefix):
+    '''Attach the tables loaded for a place as partitions of the shared
+    tables, keeping only the columns the matcher uses.
+
+    No rows are copied, but adding the check constraint reads every row once.'''
+    cur = conn.cursor()
+    create_parent_tables(cur)
+    for table in osm_tables:
+        name = '{}_{}'.format(prefix, table)
+        keep = partition_columns(table)
+        for column in table_columns(cur, name):
+            if column not in keep:
+                cur.execute('alter table {} drop column "{}"'.format(name, column))
+        cur.execute('alter table {} add column place_id integer not null default {:d}'.format(
+            name, place_id))
+        cur.execute('alter table {} alter column way type geometry'.format(name))
+        # reads the table while only it is locked, attach can use the
+        # constraint instead of scanning again with the parent locked
+        cur.execute('alter table {} add check (place_id = {:d})'.format(name, place_id))
+        cur.execute('alter table osm_{} attach partition {} for values in ({:d})'.format(
+            table, name, place_id))
+    cur.execute('drop table if exists {}_roads'.format(prefix))
+    conn.commit()
+
+def detach_place_tables(conn, prefix):
+    '''Detach any of the tables for a place that are partitions, leaving
+    them as ordinary tables.'''
+    cur = conn.cursor()
+    for table in osm_tables:
+        name = '{}_{}'.format(prefix, table)
+        parent = partition_parent(cur, name)
+        if parent:
+            cur.execute('alter table {} detach partition {}'.format(parent, name))
+    conn.commit()
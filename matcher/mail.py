@@ -35,7 +35,12 @@ def get_area(place):
             if place.area
             else 'n/a')
 
-def error_mail(subject, data, r, via_web=True):
+def error_mail(subject, data, r, via_web=True, reply=None):
+    if reply is None:
+        reply = r.text
+    elif isinstance(reply, bytes):
+        reply = reply.decode('utf-8', 'replace')
+
     body = '''
 remote URL: {r.url}
 status code: {r.status_code}
@@ -47,8 +52,8 @@ status code: {r.status_code}
 content-type: {r.headers[content-type]}
 
 reply:
-{r.text}
-'''.format(r=r, data=data)
+{reply}
+'''.format(r=r, data=data, reply=reply)
 
     if not has_request_context():
         via_web = False
@@ -39,19 +39,114 @@ def tidy_name(n):
         return n.strip()
     return decoded
 
-def initials_match(n1, n2, endings=None):
-    n1_lc = n1.lower()
-    initals = ''.join(term[0] for term in n2 if term[0].isupper())
-    if len(initals) < 3 or len(n1) < 3:
+class NormalizedName(object):
+    '''A name with each normalisation stage used by name_match_main computed
+    once, so the same name can be compared against many others cheaply.'''
+
+    def __init__(self, name, wikidata=False):
+        self.name = name
+        self.lc = name.lower()
+        self.alnum = ''.join(c for c in name if c.isalnum())
+        self.initials = ''.join(c for c in name if c.isupper())
+        self.stripped = re_strip_non_chars.sub('', self.lc)
+
+        self.tidy = tidy_name(self.lc)
+        self.tidy_stripped = re_strip_non_chars.sub('', self.tidy)
+
+        tidy = self.tidy
+        if wikidata and 'washington, d' in tidy:  # special case for Washington, D.C.
+            tidy = tidy.replace('washington, d', 'washington d')
+        self.words = tidy.split()
+        self.reversed_words = list(reversed(self.words))
+        comma = tidy.rfind(', ')
+        self.comma_trimmed = tidy[:comma] if comma != -1 else None
+
+        self.kept = re_keep_commas.sub('', tidy)
+        self.kept_the = remove_start(self.kept, 'the ')
+        comma = self.kept.rfind(', ')
+        if comma != -1:
+            self.kept_comma_trimmed = self.kept[:comma]
+            self.kept_comma_trimmed_the = remove_start(self.kept_comma_trimmed, 'the ')
+        else:
+            self.kept_comma_trimmed = self.kept_comma_trimmed_the = None
+
+        self.final = re_strip_non_chars.sub('', self.kept)
+        self.the_stripped = self.final[3:] if self.final.startswith('the') else self.final
+
+        start = 'Statue of '
+        self.statue = (NormalizedName(name[len(start):], wikidata=True)
+                       if wikidata and name.startswith(start) else None)
+
+class NormalizedNames(object):
+    '''Wikidata names for an item, normalised once and indexed by the stages
+    that name_match_main compares for equality.'''
+
+    def __init__(self, wikidata_names):
+        self.names = wikidata_names or {}
+        self.normalized = [(name, source, NormalizedName(name, wikidata=True))
+                           for name, source in self.names.items()]
+
+        self.by_stripped = defaultdict(list)
+        self.by_the_stripped = defaultdict(list)
+        self.by_comma_trimmed = defaultdict(list)
+        self.by_kept_comma_trimmed = defaultdict(list)
+        self.by_kept_comma_trimmed_the = defaultdict(list)
+        for num, (name, source, wd) in enumerate(self.normalized):
+            if not name:
+                continue
+            self.by_stripped[wd.stripped].append(num)
+            if not wd.tidy:
+                continue
+            self.by_the_stripped[wd.the_stripped].append(num)
+            if wd.comma_trimmed is not None:
+                self.by_comma_trimmed[wd.comma_trimmed].append(num)
+            if wd.kept_comma_trimmed is not None:
+                self.by_kept_comma_trimmed[wd.kept_comma_trimmed].append(num)
+                self.by_kept_comma_trimmed_the[wd.kept_comma_trimmed_the].append(num)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def items(self):
+        return self.names.items()
+
+    def lookup(self, osm):
+        '''Positions of Wikidata names equal to the OSM name at one of the
+        exact-equality stages of name_match_main.'''
+        if not osm.name:
+            return set()
+        found = set(self.by_stripped.get(osm.stripped, []))
+        if not osm.tidy:
+            return found
+        found.update(self.by_the_stripped.get(osm.the_stripped, []))
+        if not osm.tidy.isdigit():
+            found.update(self.by_comma_trimmed.get(osm.tidy, []))
+        if not osm.kept.isdigit():
+            found.update(self.by_kept_comma_trimmed.get(osm.kept, []))
+            found.update(self.by_kept_comma_trimmed_the.get(osm.kept_the, []))
+        return found
+
+def get_stripped_endings(endings):
+    return [re_strip_non_chars.sub('', tidy_name(e)) for e in endings or []]
+
+def normalized_initials_match(n1, n2, endings=None):
+    initals = n2.initials
+    if len(initals) < 3 or len(n1.name) < 3:
         return
-    if initals == n1:
+    if initals == n1.name:
         return Match(MatchType.initials)
-    if initals == ''.join(c for c in n1 if c.isalnum()):
+    if initals == n1.alnum:
         return Match(MatchType.initials)
     if any(initals == trim for trim in
-            [n1[:-len(end)].strip() for end in endings or [] if n1_lc.endswith(end.lower())]):
+            [n1.name[:-len(end)].strip() for end in endings or [] if n1.lc.endswith(end.lower())]):
         return Match(MatchType.initials_trim)
 
+def initials_match(n1, n2, endings=None):
+    return normalized_initials_match(NormalizedName(n1), NormalizedName(n2), endings)
+
 def match_with_words_removed(osm, wd, words):
     if not words:
         return False
@@ -61,58 +156,47 @@ def match_with_words_removed(osm, wd, words):
     return any(x_wd.replace(word, '') == x_osm.replace(word, '')
                for word in words)
 
-def name_match_main(osm, wd, endings=None, debug=False):
-    wd_lc = wd.lower()
-    osm_lc = osm.lower()
-    if not wd or not osm:
+def normalized_match_main(osm, wd, endings=None, stripped_endings=None):
+    if not wd.name or not osm.name:
         return
 
-    m = initials_match(osm, wd, endings) or initials_match(wd, osm, endings)
+    m = (normalized_initials_match(osm, wd, endings) or
+         normalized_initials_match(wd, osm, endings))
     if m:
         return m
 
-    if re_strip_non_chars.sub('', wd_lc) == re_strip_non_chars.sub('', osm_lc):
+    if wd.stripped == osm.stripped:
         return Match(MatchType.good)
 
-    wd_lc = tidy_name(wd_lc)
-    osm_lc = tidy_name(osm_lc)
-
-    if not wd_lc or not osm_lc:
+    if not wd.tidy or not osm.tidy:
         return
 
-    if endings and match_with_words_removed(osm_lc, wd_lc, [tidy_name(e) for e in endings]):
-        return Match(MatchType.good)
+    if endings:
+        if stripped_endings is None:
+            stripped_endings = get_stripped_endings(endings)
+        if any(wd.tidy_stripped.replace(word, '') == osm.tidy_stripped.replace(word, '')
+               for word in stripped_endings):
+            return Match(MatchType.good)
 
-    if wd_lc == osm_lc:
-        # print ('{} == {} was: {}'.format(wd_lc, osm_lc, osm))
+    if wd.tidy == osm.tidy:
         return Match(MatchType.good)
-    if 'washington, d' in wd_lc:  # special case for Washington, D.C.
-        wd_lc = wd_lc.replace('washington, d', 'washington d')
-    comma = wd_lc.rfind(', ')
-    if comma != -1 and not osm_lc.isdigit() and wd_lc[:comma] == osm_lc:
+    if (wd.comma_trimmed is not None and not osm.tidy.isdigit() and
+            wd.comma_trimmed == osm.tidy):
         return Match(MatchType.good)
-    if wd_lc.split() == list(reversed(osm_lc.split())):
+    if wd.words == osm.reversed_words:
         return Match(MatchType.good)
 
-    wd_lc = re_keep_commas.sub('', wd_lc)
-    osm_lc = re_keep_commas.sub('', osm_lc)
-
-    comma = wd_lc.rfind(', ')
-    if comma != -1 and not osm_lc.isdigit():
-        if wd_lc[:comma] == osm_lc:
+    if wd.kept_comma_trimmed is not None and not osm.kept.isdigit():
+        if wd.kept_comma_trimmed == osm.kept:
             return Match(MatchType.good)
-        if remove_start(wd_lc[:comma], 'the ') == remove_start(osm_lc, 'the '):
+        if wd.kept_comma_trimmed_the == osm.kept_the:
             return Match(MatchType.good)
 
-    wd_lc = re_strip_non_chars.sub('', wd_lc)
-    osm_lc = re_strip_non_chars.sub('', osm_lc)
-    if wd_lc == osm_lc:
+    if wd.final == osm.final:
         return Match(MatchType.good)
 
-    if wd_lc.startswith('the'):
-        wd_lc = wd_lc[3:]
-    if osm_lc.startswith('the'):
-        osm_lc = osm_lc[3:]
+    wd_lc = wd.the_stripped
+    osm_lc = osm.the_stripped
     if wd_lc == osm_lc:
         return Match(MatchType.good)
 
@@ -127,15 +211,24 @@ def name_match_main(osm, wd, endings=None, debug=False):
             return Match(MatchType.trim)
     return
 
-def name_match(osm, wd, endings=None, debug=False):
-    match = name_match_main(osm, wd, endings, debug)
+def normalized_match(osm, wd, endings=None, stripped_endings=None):
+    match = normalized_match_main(osm, wd, endings, stripped_endings)
     if match:
         return match
 
-    start = 'Statue of '
-    if wd.startswith(start) and name_match_main(osm, wd[len(start):], endings):
+    if wd.statue and normalized_match_main(osm, wd.statue, endings, stripped_endings):
         return Match(MatchType.trim)
 
+def name_match_main(osm, wd, endings=None, debug=False):
+    return normalized_match_main(NormalizedName(osm),
+                                 NormalizedName(wd, wikidata=True),
+                                 endings)
+
+def name_match(osm, wd, endings=None, debug=False):
+    return normalized_match(NormalizedName(osm),
+                            NormalizedName(wd, wikidata=True),
+                            endings)
+
 def normalize_name(name):
     return re_strip_non_chars.sub('', name.lower())
 
@@ -188,13 +281,47 @@ def get_names(osm_tags):
     return {k: v for k, v in osm_tags.items()
              if 'name' in k and k not in bad_name_fields}
 
+def get_normalized_osm_names(osm_tags):
+    return [(osm_key, o, NormalizedName(o))
+            for osm_key, o in get_names(osm_tags).items()]
+
+def get_good_hits(wikidata_names, osm_names, endings=None):
+    '''Sorted (Wikidata position, OSM position) pairs that are equal at one of
+    the exact-equality stages, these are good matches unless the names also
+    match as initials, which name_match_main checks first.'''
+    hits = set()
+    for j, (osm_key, o, osm) in enumerate(osm_names):
+        hits.update((i, j) for i in wikidata_names.lookup(osm))
+
+    good = []
+    for i, j in sorted(hits):
+        wd = wikidata_names.normalized[i][2]
+        osm = osm_names[j][2]
+        if not (normalized_initials_match(osm, wd, endings) or
+                normalized_initials_match(wd, osm, endings)):
+            good.append((i, j))
+    return hits, good
+
 def check_for_match(osm_tags, wikidata_names, endings=None):
-    names = get_names(osm_tags)
+    if not isinstance(wikidata_names, NormalizedNames):
+        wikidata_names = NormalizedNames(wikidata_names)
+    osm_names = get_normalized_osm_names(osm_tags)
+    stripped_endings = get_stripped_endings(endings)
+
+    # hash lookups find most good matches, only the pairs that come before the
+    # first of these need to go through the full comparison
+    hits, good = get_good_hits(wikidata_names, osm_names, endings)
+    first_good = good[0] if good else None
 
     best = None
-    for w, source in wikidata_names.items():
-        for osm_key, o in names.items():
-            m = name_match(o, w, endings)
+    for i, (w, source, wd) in enumerate(wikidata_names.normalized):
+        for j, (osm_key, o, osm) in enumerate(osm_names):
+            if (i, j) == first_good:
+                m = Match(MatchType.good)
+            elif (i, j) in hits:
+                continue  # initials match, not good enough to return
+            else:
+                m = normalized_match(osm, wd, endings, stripped_endings)
             if m:
                 m.wikidata_name = w
                 m.wikidata_source = source
@@ -216,12 +343,21 @@ def check_for_match(osm_tags, wikidata_names, endings=None):
     return address_match or best
 
 def get_all_matches(osm_tags, wikidata_names, endings=None):
-    names = get_names(osm_tags)
+    if not isinstance(wikidata_names, NormalizedNames):
+        wikidata_names = NormalizedNames(wikidata_names)
+    osm_names = get_normalized_osm_names(osm_tags)
+    stripped_endings = get_stripped_endings(endings)
+
+    hits, good = get_good_hits(wikidata_names, osm_names, endings)
+    good = set(good)
 
     matches = []
-    for w, source in wikidata_names.items():
-        for osm_key, o in names.items():
-            m = name_match(o, w, endings)
+    for i, (w, source, wd) in enumerate(wikidata_names.normalized):
+        for j, (osm_key, o, osm) in enumerate(osm_names):
+            if (i, j) in good:
+                m = Match(MatchType.good)
+            else:
+                m = normalized_match(osm, wd, endings, stripped_endings)
             if m:
                 m.wikidata_name = w
                 m.wikidata_source = source
@@ -1,62 +1,174 @@
 from flask import current_app
-from collections import Counter, defaultdict
-from .model import ItemCandidate
-from . import match, database
-
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from .model import ItemCandidate, BadMatch
+from sqlalchemy import tuple_
+from sqlalchemy.dialects.postgresql import insert
+from . import match, database, utils
+
+import psycopg2.extras
+import itertools
+import weakref
+import heapq
 import os.path
 import json
 import re
+from time import time
 
 bad_name_fields = {'tiger:name_base', 'old_name', 'name:right', 'name:left',
                    'gnis:county_name', 'openGeoDB:name'}
 
 cat_to_ending = {}
 patterns = {}
-entity_types = {}
 default_max_dist = 4
+entity_type_index = None
+entity_types_check_interval = 10  # seconds between checks for a changed file
+
+re_word = re.compile(r'\w+')
 
 def get_pattern(key):
     if key in patterns:
         return patterns[key]
     return patterns.setdefault(key, re.compile(r'\b' + re.escape(key) + r'\b', re.I))
 
-def categories_to_tags(categories, cat_to_entity=None):
-    if cat_to_entity is None:
-        cat_to_entity = build_cat_map()
-    tags = set()
-    for cat in categories:
-        lc_cat = cat.lower()
+def is_word_boundary(s, pos):
+    before = pos > 0 and bool(re_word.match(s[pos - 1]))
+    after = pos < len(s) and bool(re_word.match(s[pos]))
+    return before != after
+
+class CategoryMatcher(object):
+    '''Find every key from the category map in a category with one scan
+    over the words of the category, instead of one regex search per key.'''
+
+    def __init__(self, cat_to_entity):
+        self.by_first_word = defaultdict(list)
+        self.other_keys = []  # keys that don't start with a word character
+        self.exclude = {}
         for key, value in cat_to_entity.items():
-            if not get_pattern(key).search(lc_cat):
-                continue
+            m = re_word.match(key.lower())
+            if m:
+                self.by_first_word[m.group()].append((key.lower(), value))
+            else:
+                self.other_keys.append((key, value))
+
             exclude = value.get('exclude_cats')
-            if exclude:
+            if exclude and id(value) not in self.exclude:
                 pattern = re.compile(r'\b(' + '|'.join(re.escape(e) for e in exclude) + r')\b', re.I)
-                if pattern.search(lc_cat):
-                    continue
+                self.exclude[id(value)] = pattern
+
+    def matches(self, lc_cat):
+        '''(key, entity type) pairs for every key found in the lowercase
+        category, the same keys get_pattern(key).search(lc_cat) finds.'''
+        found = {}
+        for word in re_word.finditer(lc_cat):
+            start = word.start()
+            for key, value in self.by_first_word.get(word.group(), []):
+                if (key not in found and lc_cat.startswith(key, start) and
+                        is_word_boundary(lc_cat, start + len(key))):
+                    found[key] = value
+        for key, value in self.other_keys:
+            if get_pattern(key).search(lc_cat):
+                found[key] = value
+        return found.items()
+
+    def entity_types(self, cat):
+        '''Entity types matching a category, skipping those with an
+        exclude_cats pattern that matches.'''
+        lc_cat = cat.lower()
+        for key, value in self.matches(lc_cat):
+            exclude = self.exclude.get(id(value))
+            if exclude and exclude.search(lc_cat):
+                continue
+            yield value
+
+class EntityTypeIndex(object):
+    '''Entity types from entity_types.json with the category matcher and
+    lookups from tag to entity types, trim endings and max distance.'''
+
+    def __init__(self, entity_types, filename=None, mtime=None):
+        self.entity_types = entity_types
+        self.filename = filename
+        self.mtime = mtime
+        self.checked = time()
+        self.cat_to_entity = build_cat_map(entity_types)
+        self.category_matcher = CategoryMatcher(self.cat_to_entity)
+
+        self.tag_to_types = defaultdict(list)
+        self.tag_to_trim = defaultdict(set)
+        self.tag_to_max_dist = {}
+        for t in entity_types:
+            type_max_dist = t.get('max_dist')
+            for tag in set(t['tags']):
+                self.tag_to_types[tag].append(t)
+                self.tag_to_trim[tag].update(t.get('trim', []))
+                if type_max_dist:
+                    self.tag_to_max_dist[tag] = max(type_max_dist,
+                                                    self.tag_to_max_dist.get(tag, 0))
+
+    @classmethod
+    def load(cls, filename):
+        return cls(json.load(open(filename)),
+                   filename=filename,
+                   mtime=os.stat(filename).st_mtime)
+
+    def is_current(self, filename):
+        '''False if the file has changed, only looking at the file once every
+        entity_types_check_interval seconds.'''
+        if filename != self.filename:
+            return False
+        now = time()
+        if now - self.checked < entity_types_check_interval:
+            return True
+        self.checked = now
+        return os.stat(filename).st_mtime == self.mtime
+
+    def endings(self, tags):
+        endings = set()
+        for tag in set(tags):
+            endings.update(self.tag_to_trim.get(tag, []))
+        return endings
+
+    def max_dist(self, tags):
+        max_dists = [self.tag_to_max_dist[tag] for tag in set(tags)
+                     if tag in self.tag_to_max_dist]
+        return max(max_dists) if max_dists else None
+
+def entity_types_filename():
+    data_dir = current_app.config['DATA_DIR']
+    return os.path.join(data_dir, 'entity_types.json')
+
+def get_entity_type_index():
+    '''Entity type index, loaded once and reloaded if the file changes.'''
+    global entity_type_index
+
+    filename = entity_types_filename()
+    if entity_type_index is None or not entity_type_index.is_current(filename):
+        entity_type_index = EntityTypeIndex.load(filename)
+    return entity_type_index
+
+def get_category_matcher(cat_to_entity=None):
+    if cat_to_entity is not None:
+        return CategoryMatcher(cat_to_entity)
+    return get_entity_type_index().category_matcher
+
+def categories_to_tags(categories, cat_to_entity=None):
+    cat_matcher = get_category_matcher(cat_to_entity)
+    tags = set()
+    for cat in categories:
+        for value in cat_matcher.entity_types(cat):
             tags |= set(value['tags'])
     return sorted(tags)
 
 def categories_to_tags_map(categories):
-    cat_to_entity = build_cat_map()
+    cat_matcher = get_category_matcher()
     ret = defaultdict(set)
     for cat in categories:
-        lc_cat = cat.lower()
-        for key, value in cat_to_entity.items():
-            if not get_pattern(key).search(lc_cat):
-                continue
-            exclude = value.get('exclude_cats')
-            if exclude:
-                pattern = re.compile(r'\b(' + '|'.join(re.escape(e) for e in exclude) + r')\b', re.I)
-                if pattern.search(lc_cat):
-                    continue
+        for value in cat_matcher.entity_types(cat):
             ret[cat] |= set(value['tags'])
     return ret
 
 def load_entity_types():
-    data_dir = current_app.config['DATA_DIR']
-    filename = os.path.join(data_dir, 'entity_types.json')
-    return json.load(open(filename))
+    return json.load(open(entity_types_filename()))
 
 def simplify_tags(tags):
     key_only = sorted(t for t in tags if '=' not in t)
@@ -66,9 +178,11 @@ def simplify_tags(tags):
                 tags.remove(t)
     return tags
 
-def build_cat_map():
+def build_cat_map(entity_types=None):
+    if entity_types is None:
+        return get_entity_type_index().cat_to_entity
     cat_to_entity = {}
-    for i in load_entity_types():
+    for i in entity_types:
         for c in i['cats']:
             lc_cat = c.lower()
             if ' by ' in lc_cat:
@@ -77,77 +191,87 @@ def build_cat_map():
     return cat_to_entity
 
 def get_ending_from_criteria(tags):
-    global entity_types
-
-    if not entity_types:
-        entity_types = load_entity_types()
-    tags = set(tags)
-
-    endings = set()
-    for t in entity_types:
-        if tags & set(t['tags']):
-            endings.update(t.get('trim', []))
-
-    return endings
+    return get_entity_type_index().endings(tags)
 
 def get_max_dist_from_criteria(tags):
-    global entity_types
-
-    if not entity_types:
-        entity_types = load_entity_types()
-    tags = set(tags)
-
-    max_dists = []
-    for t in entity_types:
-        type_max_dist = t.get('max_dist')
-        if type_max_dist and tags & set(t['tags']):
-            max_dists.append(type_max_dist)
-
-    return max(max_dists) if max_dists else None
-
-def find_item_matches(cur, item, prefix, debug=False):
-    if not item or not item.entity:
-        return []
-    cats = item.categories or []
+    return get_entity_type_index().max_dist(tags)
 
-    # point = "ST_GeomFromEWKT('{}')".format(item.ewkt)
-    point = "ST_TRANSFORM(ST_GeomFromEWKT('{}'), 3857)".format(item.ewkt)
+item_query_params = ('point', 'max_dist', 'tag_keys', 'tag_pair_keys', 'tag_pair_values')
 
-    # item_max_dist = max(max_dist[cat] for cat in item['cats'])
-    item_max_dist = get_max_dist_from_criteria(item.tags) or default_max_dist
-
-    hstore = item.hstore_query
-    if not hstore:
-        return []
+def item_query_sql(prefix, placeholders):
+    '''SQL to find candidates near one item, placeholders maps each name in
+    item_query_params to a bind parameter.
 
+    The casts give plain SQL the same types as the prepared statement, without
+    them an empty list is sent as '{}' and unnest can't pick a type.'''
+    placeholders = dict(placeholders)
+    placeholders['max_dist'] += '::float'
+    for p in 'tag_keys', 'tag_pair_keys', 'tag_pair_values':
+        placeholders[p] += '::text[]'
+    point = 'ST_Transform(ST_GeomFromEWKT({point}), 3857)'.format(**placeholders)
     sql_list = []
     for obj_type in 'point', 'line', 'polygon':
         obj_sql = ('select \'{}\', osm_id, name, tags, '
                    'ST_Distance({}, way) as dist '
                    'from {}_{} '
-                   'where ST_DWithin({}, way, {} * 1000)').format(obj_type, point, prefix, obj_type, point, item_max_dist)
+                   'where ST_DWithin({}, way, {} * 1000)').format(obj_type, point, prefix, obj_type, point,
+                                                                placeholders['max_dist'])
         sql_list.append(obj_sql)
-    sql = 'select * from (' + ' union '.join(sql_list) + ') a where ({}) order by dist'.format(hstore)
+    tag_match = ('tags ?| {tag_keys} or exists ('
+                 'select 1 from unnest({tag_pair_keys}, {tag_pair_values}) as t(k, v) '
+                 'where tags -> t.k = t.v)').format(**placeholders)
+    return 'select * from (' + ' union '.join(sql_list) + ') a where ({}) order by dist'.format(tag_match)
+
+def item_query_args(item):
+    max_dist = get_max_dist_from_criteria(item.tags) or default_max_dist
+    values = (item.ewkt, max_dist) + item_tag_criteria(item.tags)
+    return dict(zip(item_query_params, values))
+
+prepared_statements = weakref.WeakKeyDictionary()
+
+def prepare_item_query(cur, prefix):
+    '''Prepare the item query for a place once per database connection and
+    return the name of the prepared statement.'''
+    name = 'find_item_matches_' + prefix
+    done = prepared_statements.setdefault(cur.connection, set())
+    if name in done:
+        return name
+
+    placeholders = {p: '${}'.format(num) for num, p in enumerate(item_query_params, 1)}
+    sql = 'prepare {} (text, float, text[], text[], text[]) as {}'.format(name, item_query_sql(prefix, placeholders))
+    cur.execute(sql)
+    done.add(name)
+    return name
 
-    if debug:
-        print(sql)
+def execute_item_query_sql(name):
+    return 'execute {} ({})'.format(name, ', '.join('%({})s'.format(p) for p in item_query_params))
 
-    cur.execute(sql)
-    rows = cur.fetchall()
-    seen = set()
+def find_item_matches(cur, item, prefix, debug=False):
+    if not item or not item.entity or not item.tags:
+        return []
+
+    name = prepare_item_query(cur, prefix)
+    args = item_query_args(item)
+    if debug:
+        print(name, args)
 
-    endings = get_ending_from_criteria(item.tags)
+    cur.execute(execute_item_query_sql(name), args)
+    return check_item_candidates(item, cur.fetchall(), debug=debug)
 
-    wikidata_names = item.names()
+def filter_candidate_rows(item, rows, debug=False):
+    '''Drop candidate rows that can't match the item, before name matching,
+    rows are (src_type, src_id, name, tags, dist) ordered by distance.'''
+    cats = item.categories or []
+    seen = set()
 
-    candidates = []
-    for osm_num, (src_type, src_id, osm_name, osm_tags, dist) in enumerate(rows):
+    filtered = []
+    for src_type, src_id, osm_name, osm_tags, dist in rows:
         (osm_type, osm_id) = get_osm_id_and_type(src_type, src_id)
-        if (obj_type, osm_id) in seen:
+        if (osm_type, osm_id) in seen:
             continue
         if debug:
             print((osm_type, osm_id, osm_name, osm_tags, dist))
-        seen.add((obj_type, osm_id))
+        seen.add((osm_type, osm_id))
 
         if osm_tags.get('locality') == 'townland' and 'locality=townland' not in item.tags:
             continue  # only match townlands when specifically searching for one
@@ -164,9 +288,6 @@ def find_item_matches(cur, item, prefix, debug=False):
         if not names:
             continue
 
-        m = match.check_for_match(osm_tags, wikidata_names, endings)
-        if not m:
-            continue
         candidate = {
             'osm_type': osm_type,
             'osm_id': osm_id,
@@ -177,8 +298,172 @@ def find_item_matches(cur, item, prefix, debug=False):
             'planet_table': src_type,
             'src_id': src_id,
         }
-        candidates.append(candidate)
-    return candidates
+        filtered.append(candidate)
+    return filtered
+
+def name_match_job(item, candidates):
+    '''Everything name matching needs for one item as plain data, so it
+    can be sent to a worker process.'''
+    return {
+        'item_id': item.item_id,
+        'names': dict(item.names() or {}),
+        'endings': sorted(get_ending_from_criteria(item.tags)),
+        'osm_tags': [c['tags'] for c in candidates],
+    }
+
+def run_name_match_job(job):
+    '''Name match an item against its candidates, returns the positions of
+    the candidates that match.'''
+    wikidata_names = match.NormalizedNames(job['names'])
+    endings = set(job['endings'])
+    return [num for num, osm_tags in enumerate(job['osm_tags'])
+            if match.check_for_match(osm_tags, wikidata_names, endings)]
+
+def run_name_match_jobs(jobs):
+    return [run_name_match_job(job) for job in jobs]
+
+def check_item_candidates(item, rows, debug=False):
+    '''Run name matching for an item over candidate rows from the OSM tables,
+    rows are (src_type, src_id, name, tags, dist) ordered by distance.'''
+    candidates = filter_candidate_rows(item, rows, debug=debug)
+    if not candidates:
+        return []
+    matched = run_name_match_job(name_match_job(item, candidates))
+    return [candidates[num] for num in matched]
+
+def item_tag_criteria(tags):
+    '''Tag criteria as arrays: keys to test with ?| and key/value pairs.'''
+    keys, pair_keys, pair_values = [], [], []
+    for tag in sorted(tags):
+        if '=' in tag:
+            k, _, v = tag.partition('=')
+            pair_keys.append(k)
+            pair_values.append(v)
+        else:
+            keys.append(tag)
+    return (keys, pair_keys, pair_values)
+
+def bulk_candidate_sql(prefix, obj_type):
+    return '''
+select i.item_id, '{obj_type}', osm.osm_id, osm.name, osm.tags,
+       ST_Distance(i.location, osm.way) as dist
+from matcher_item i, lateral (
+    select osm_id, name, tags, way
+    from {prefix}_{obj_type}
+    where ST_DWithin(i.location, way, i.max_dist * 1000)
+      and (tags ?| i.tag_keys or exists (
+        select 1
+        from unnest(i.tag_pair_keys, i.tag_pair_values) as t(k, v)
+        where tags -> t.k = t.v))
+) osm
+order by i.item_id, dist'''.format(prefix=prefix, obj_type=obj_type)
+
+def load_matcher_items(cur, items):
+    '''Put the location, max distance and tag criteria of every item into a
+    temporary table, dropped at the end of the transaction.'''
+    cur.execute('''
+create temporary table matcher_item (
+    item_id integer primary key,
+    location geometry,
+    max_dist float,
+    tag_keys text[],
+    tag_pair_keys text[],
+    tag_pair_values text[]
+) on commit drop''')
+
+    rows = []
+    for item in items:
+        max_dist = get_max_dist_from_criteria(item.tags) or default_max_dist
+        rows.append((item.item_id, max_dist) + item_tag_criteria(item.tags))
+
+    sql = '''
+insert into matcher_item
+select v.item_id, ST_Transform(item.location::geometry, 3857), v.max_dist,
+       v.tag_keys, v.tag_pair_keys, v.tag_pair_values
+from (values %s) as v(item_id, max_dist, tag_keys, tag_pair_keys, tag_pair_values)
+join item on item.item_id = v.item_id'''
+    template = '(%s, %s, %s::text[], %s::text[], %s::text[])'
+    psycopg2.extras.execute_values(cur, sql, rows, template=template)
+    cur.execute('analyze matcher_item')
+
+def iter_item_candidate_rows(conn, items, prefix, debug=False):
+    '''Candidate rows for many items with one query per geometry table
+    instead of a query per item.
+
+    Yields (item, rows) in item_id order, rows are the same as
+    find_item_matches passes to check_item_candidates.'''
+    items = sorted(items, key=lambda item: item.item_id)
+    search = [item for item in items if item.entity and item.tags]
+    if not search:
+        for item in items:
+            yield item, []
+        return
+
+    load_matcher_items(conn.cursor(), search)
+
+    streams = []
+    for obj_type in 'point', 'line', 'polygon':
+        cur = conn.cursor('matcher_' + obj_type)  # server-side cursor
+        sql = bulk_candidate_sql(prefix, obj_type)
+        if debug:
+            print(sql)
+        cur.execute(sql)
+        streams.append(cur)
+
+    merged = heapq.merge(*streams, key=lambda row: (row[0], row[-1]))
+    grouped = itertools.groupby(merged, key=lambda row: row[0])
+    item_id, rows = next(grouped, (None, None))
+
+    for item in items:
+        if item_id != item.item_id:
+            yield item, []
+            continue
+        candidate_rows = [row[1:] for row in rows]
+        item_id, rows = next(grouped, (None, None))
+        yield item, candidate_rows
+
+    for cur in streams:
+        cur.close()
+    conn.commit()
+
+def parallel_item_matches(item_rows, workers, debug=False, batch_size=50):
+    '''Name match items in a pool of worker processes.
+
+    The main process filters candidate rows and builds a job per item,
+    workers only get plain data and send back the positions of matching
+    candidates. Results are yielded in the same order as item_rows.'''
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight = deque()
+        for batch in utils.chunk(item_rows, batch_size):
+            batch = [(item, filter_candidate_rows(item, rows, debug=debug))
+                     for item, rows in batch]
+            jobs = [name_match_job(item, candidates) for item, candidates in batch]
+            in_flight.append((batch, executor.submit(run_name_match_jobs, jobs)))
+            if len(in_flight) < workers * 2:
+                continue
+            yield from name_match_results(*in_flight.popleft())
+
+        while in_flight:
+            yield from name_match_results(*in_flight.popleft())
+
+def name_match_results(batch, future):
+    for (item, candidates), matched in zip(batch, future.result()):
+        yield item, [candidates[num] for num in matched]
+
+def find_all_item_matches(conn, items, prefix, debug=False, workers=None):
+    '''Find candidates for many items with one query per geometry table
+    instead of a query per item.
+
+    Yields (item, candidates) in item_id order, candidates are the same as
+    find_item_matches would return for the item. With more than one worker
+    name matching is spread over a process pool.'''
+    item_rows = iter_item_candidate_rows(conn, items, prefix, debug=debug)
+    if workers and workers > 1:
+        yield from parallel_item_matches(item_rows, workers, debug=debug)
+        return
+
+    for item, rows in item_rows:
+        yield item, check_item_candidates(item, rows, debug=debug)
 
 def run_individual_match(place, item):
     conn = database.session.bind.raw_connection()
@@ -203,6 +488,36 @@ def save_individual_matches(place, item, candidates):
             database.session.delete(c)
     database.session.commit()
 
+def save_candidates(item_ids, candidates):
+    '''Make the stored candidates for the given items match the list of
+    candidates found, with one query to find existing candidates, one batched
+    delete and one insert.
+
+    Existing candidates that are found again are left alone.'''
+    if not item_ids:
+        return
+    session = database.session
+    cols = (ItemCandidate.item_id, ItemCandidate.osm_id, ItemCandidate.osm_type)
+    existing = set(session.query(*cols).filter(ItemCandidate.item_id.in_(item_ids)))
+    found = {(c['item_id'], c['osm_id'], c['osm_type']): c for c in candidates}
+
+    stale = existing - found.keys()
+    if stale:
+        bad_cols = (BadMatch.item_id, BadMatch.osm_id, BadMatch.osm_type)
+        (session.query(BadMatch)
+                .filter(tuple_(*bad_cols).in_(stale))
+                .delete(synchronize_session=False))
+        (session.query(ItemCandidate)
+                .filter(tuple_(*cols).in_(stale))
+                .delete(synchronize_session=False))
+
+    new = [c for key, c in found.items() if key not in existing]
+    if new:
+        session.execute(insert(ItemCandidate.__table__)
+                        .values(new)
+                        .on_conflict_do_nothing())
+    session.commit()
+
 def get_osm_id_and_type(source_type, source_id):
     if source_type == 'point':
         return ('node', source_id)
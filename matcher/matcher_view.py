@@ -1,5 +1,5 @@
-from flask import Blueprint, abort, redirect, render_template, g, Response, jsonify, request
-from . import database, wikidata, matcher, mail
+from flask import Blueprint, abort, redirect, render_template, g, Response, jsonify, request, current_app
+from . import database, wikidata, matcher, mail, overpass
 from .model import Item
 from .place import Place
 from .utils import is_bot
@@ -7,6 +7,7 @@ from .utils import is_bot
 import requests
 
 matcher_blueprint = Blueprint('matcher', __name__)
+default_max_area = 2000  # km², raise MATCHER_MAX_AREA when using WIKIDATA_TILE_AREA
 
 def announce_matcher(place):
     ''' Send mail to announce somebody is trying the matcher. '''
@@ -44,7 +45,8 @@ def matcher_progress(osm_type, osm_id):
     if place.state == 'ready':
         return redirect(place.candidates_url())
 
-    if osm_type != 'node' and place.area and place.area_in_sq_km > 2000:
+    max_area = current_app.config.get('MATCHER_MAX_AREA', default_max_area)
+    if osm_type != 'node' and place.area and place.area_in_sq_km > max_area:
         message = '{}: area is too large for matcher'.format(place.name)
         return render_template('error_page.html', message=message)
 
@@ -124,9 +126,7 @@ def load_osm2pgsql(place_id):
     place = Place.query.get(place_id)
     if not place:
         abort(404)
-    expect = [place.prefix + '_' + t for t in ('line', 'point', 'polygon')]
-    tables = database.get_tables()
-    if not all(t in tables for t in expect):
+    if not database.place_tables_exist(place.prefix):
         error = place.load_into_pgsql()
         if error:
             mail.place_error(place, 'osm2pgl', error)
@@ -163,7 +163,8 @@ def load_ready(place_id):
 @matcher_blueprint.route('/overpass/<int:place_id>', methods=['POST'])
 def post_overpass(place_id):
     place = Place.query.get(place_id)
-    place.save_overpass(request.data)
+    chunks = iter(lambda: request.stream.read(overpass.stream_chunk_size), b'')
+    place.save_overpass(chunks)
     place.state = 'overpass'
     database.session.commit()
     return Response('done', mimetype='text/plain')
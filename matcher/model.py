@@ -10,9 +10,11 @@ from sqlalchemy.orm import relationship, backref, column_property
 from sqlalchemy.sql.expression import cast
 from .database import session
 from flask_login import UserMixin
-from . import wikidata, matcher, match
+from . import wikidata, wikipedia, matcher, match
+from .utils import chunk
 from .overpass import oql_from_tag
 from collections import defaultdict
+from datetime import datetime, timedelta
 
 Base = declarative_base()
 Base.query = session.query_property()
@@ -267,6 +269,62 @@ class Category(Base):
     name = Column(String, primary_key=True)
     page_count = Column(Integer)
 
+class WikipediaPage(Base):
+    '''Categories and intro extract of a Wikipedia article, cached so
+    overlapping places don't download the same article again.'''
+    __tablename__ = 'wikipedia_page'
+
+    language = Column(String, primary_key=True)
+    title = Column(String, primary_key=True)
+    lastrevid = Column(BigInteger, nullable=False)
+    categories = Column(postgresql.ARRAY(String))
+    extract = Column(Text)
+    extract_names = Column(postgresql.ARRAY(String))
+    fetched = Column(DateTime, nullable=False)
+
+    @classmethod
+    def get_pages(cls, titles, language='en'):
+        '''Map title to page, only downloading pages that are missing from
+        the cache or have been edited since they were fetched.'''
+        titles = set(titles)
+        pages = {}
+        for cur in chunk(titles, 1000):
+            q = cls.query.filter(cls.language == language, cls.title.in_(cur))
+            pages.update((page.title, page) for page in q)
+
+        now = datetime.utcnow()
+        max_age = timedelta(seconds=wikipedia.get_cache_max_age())
+        fetch = [title for title in titles if title not in pages]
+        stale = [title for title, page in pages.items() if now - page.fetched > max_age]
+        if stale:
+            revisions = wikipedia.latest_revisions(stale, language)
+            for title in stale:
+                if revisions.get(title) == pages[title].lastrevid:
+                    pages[title].fetched = now
+                else:
+                    fetch.append(title)
+
+        found = wikipedia.fetch_pages(fetch, language) if fetch else {}
+        for title in fetch:
+            page = pages.get(title)
+            if title not in found:  # page no longer exists
+                if page:
+                    session.delete(pages.pop(title))
+                continue
+            if not page:
+                page = pages[title] = cls(language=language, title=title)
+                session.add(page)
+            data = found[title]
+            page.lastrevid = data['lastrevid']
+            page.categories = data['categories']
+            page.extract = data['extract']
+            page.extract_names = (wikipedia.html_names(data['extract'])
+                                  if data['extract'] else None)
+            page.fetched = now
+
+        session.commit()
+        return pages
+
 class Changeset(Base):
     __tablename__ = 'changeset'
     id = Column(BigInteger, primary_key=True)
@@ -3,14 +3,20 @@ import re
 import requests
 import os.path
 import json
+import gzip
+import heapq
+import hashlib
 import simplejson
 from flask import current_app
-from time import sleep
+from time import sleep, time
 from . import user_agent_headers, mail
+from .utils import DiskCache
 from collections import defaultdict
+from lxml import etree
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 re_slot_available = re.compile('^Slot available after: ([^,]+), in (-?\d+) seconds?\.$')
-re_available_now = re.compile('^\d+ slots available now.$')
+re_available_now = re.compile('^(\d+) slots available now.$')
 
 name_only_tag = {'area=yes', 'type=tunnel', 'leisure=park', 'leisure=garden',
         'site=aerodome', 'amenity=hospital', 'boundary', 'amenity=pub',
@@ -24,12 +30,24 @@ overpass_url = 'http://overpass-api.de/api/interpreter'
 # overpass_url = 'http://overpass.osm.rambler.ru/cgi/interpreter'
 # overpass_url = 'http://api.openstreetmap.fr/oapi/interpreter'
 
+default_cache_size = 2 * 1024 ** 3  # bytes
+default_cache_ttl = 7 * 24 * 60 * 60  # seconds
+existing_ttl = 60 * 60
+stream_chunk_size = 64 * 1024
+osm_type_order = {'node': 0, 'way': 1, 'relation': 2}
+error_check_size = 4096  # Overpass error replies are shorter than this
+no_slot_wait = 5  # seconds, doubled each time there is still no free slot
+max_no_slot_wait = 60
+
 class RateLimited(Exception):
     pass
 
 class Timeout(Exception):
     pass
 
+class OutOfMemory(Exception):
+    pass
+
 def name_only(t):
     return (t in name_only_tag or
             ('=' in t and any(t.startswith(key + '=') for key in name_only_key)))
@@ -176,12 +194,14 @@ def parse_status(status):
         slots.append(int(m.group(2)))
 
     next_line = lines[i]
-    assert (re_available_now.match(next_line) or
+    m = re_available_now.match(next_line)
+    assert (m or
             next_line == 'Currently running queries (pid, space limit, time limit, start time):')
 
     return {
         'rate_limit': int(lines[2][len(limit):]),
         'slots': slots,
+        'free': int(m.group(1)) if m else 0,
         'running': len(lines) - (i + 1)
     }
 
@@ -191,29 +211,97 @@ def get_status(url=None):
     status = requests.get(url).text
     return parse_status(status)
 
-def wait_for_slot(status=None, url=None):
+def wait_for_slot(status=None, url=None, attempt=0):
+    '''Sleep until a slot should be free. When other clients hold every slot
+    the status doesn't say when one will be free, wait longer with each
+    attempt.'''
     if status is None:
         status = get_status(url=url)
     slots = status['slots']
     if slots:
-        print('waiting {} seconds'.format(slots[0]))
-        sleep(slots[0] + 1)
-
-def item_filename(wikidata_id, radius):
-    assert wikidata_id[0] == 'Q'
-    overpass_dir = current_app.config['OVERPASS_DIR']
-    return os.path.join(overpass_dir, '{}_{}.json'.format(wikidata_id, radius))
-
-def existing_item_filename(wikidata_id):
-    assert wikidata_id[0] == 'Q'
-    overpass_dir = current_app.config['OVERPASS_DIR']
-    return os.path.join(overpass_dir, '{}_existing.json'.format(wikidata_id))
+        seconds = max(slots[0] + 1, 1)
+    elif status['free'] == 0:
+        seconds = min(no_slot_wait * 2 ** attempt, max_no_slot_wait)
+    else:
+        return
+    print('waiting {} seconds'.format(seconds))
+    sleep(seconds)
+
+def normalize_oql(oql):
+    '''Strip indentation and blank lines so that formatting doesn't change
+    the cache key.'''
+    return '\n'.join(line.strip() for line in oql.splitlines() if line.strip())
+
+def oql_hash(oql):
+    return hashlib.sha256(normalize_oql(oql).encode('utf-8')).hexdigest()
+
+class OverpassCache(DiskCache):
+    '''Overpass replies stored gzip compressed on disk, keyed by a hash of the
+    normalised OQL.
+
+    Every entry has its own expiry time. The modification time of a file
+    records when it was last used, once the cache is bigger than max_size
+    the least recently used entries are removed.'''
+
+    def __init__(self, directory, max_size=default_cache_size, ttl=default_cache_ttl):
+        super().__init__(directory, max_size)
+        self.ttl = ttl
+
+    def filename(self, oql):
+        return os.path.join(self.directory, oql_hash(oql) + self.suffix)
+
+    def get(self, oql):
+        filename = self.filename(oql)
+        try:
+            with gzip.open(filename, 'rb') as f:
+                header = json.loads(f.readline().decode('utf-8'))
+                content = f.read()
+        except FileNotFoundError:
+            return
+        except (OSError, EOFError, ValueError):  # damaged entry
+            self.remove(filename)
+            return
+
+        if header['expires'] < time():
+            self.remove(filename)
+            return
+        try:
+            os.utime(filename)
+        except FileNotFoundError:  # evicted by another process
+            return
+        return content
+
+    def set(self, oql, content, ttl=None):
+        os.makedirs(self.directory, exist_ok=True)
+        header = {
+            'expires': time() + (self.ttl if ttl is None else ttl),
+            'oql': normalize_oql(oql),
+        }
+        filename = self.filename(oql)
+        tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+        with gzip.open(tmp_filename, 'wb') as f:
+            f.write(json.dumps(header).encode('utf-8') + b'\n')
+            f.write(content)
+        os.replace(tmp_filename, filename)
+
+        self.evict_if_due()
+
+def is_complete(data):
+    '''Overpass reports errors such as timeouts in a remark next to a partial
+    result, these replies shouldn't be cached.'''
+    return 'remark' not in data
+
+def get_cache():
+    config = current_app.config
+    return OverpassCache(os.path.join(config['OVERPASS_DIR'], 'cache'),
+                         max_size=config.get('OVERPASS_CACHE_SIZE', default_cache_size),
+                         ttl=config.get('OVERPASS_CACHE_TTL', default_cache_ttl))
 
 def item_query(oql, wikidata_id, radius=1000, refresh=False):
-    filename = item_filename(wikidata_id, radius)
-
-    if not refresh and os.path.exists(filename):
-        return json.load(open(filename))['elements']
+    cache = get_cache()
+    content = None if refresh else cache.get(oql)
+    if content is not None:
+        return json.loads(content.decode('utf-8'))['elements']
 
     r = requests.post(overpass_url, data=oql, headers=user_agent_headers())
 
@@ -231,21 +319,22 @@ def item_query(oql, wikidata_id, radius=1000, refresh=False):
         mail.error_mail('item overpass query error', oql, r)
         raise
 
-    json.dump(data, open(filename, 'w'))
+    if is_complete(data):
+        cache.set(oql, r.content)
     return data['elements']
 
 def get_existing(wikidata_id, refresh=False):
-    filename = existing_item_filename(wikidata_id)
-
-    if not refresh and os.path.exists(filename):
-        return json.load(open(filename))['elements']
-
     oql = '''
 [timeout:300][out:json];
 (node[wikidata={qid}]; way[wikidata={qid}]; rel[wikidata={qid}];);
 out qt center tags;
 '''.format(qid=wikidata_id)
 
+    cache = get_cache()
+    content = None if refresh else cache.get(oql)
+    if content is not None:
+        return json.loads(content.decode('utf-8'))['elements']
+
     r = requests.post(overpass_url, data=oql, headers=user_agent_headers())
 
     if r.status_code == 429 and 'rate_limited' in r.text:
@@ -262,7 +351,8 @@ out qt center tags;
         mail.error_mail('item overpass query error', oql, r)
         raise
 
-    json.dump(data, open(filename, 'w'))
+    if is_complete(data):
+        cache.set(oql, r.content, ttl=existing_ttl)
     return data['elements']
 
 def get_tags(elements):
@@ -273,43 +363,198 @@ def get_tags(elements):
 [timeout:300][out:json];
 ({});
 out qt tags;
-'''.format(''.join(union))
+'''.format(''.join(sorted(union)))
 
     r = requests.post(overpass_url, data=oql, headers=user_agent_headers())
 
     return r.json()['elements']
 
-def run_query(oql):
+def run_query(oql, stream=False):
     return requests.post(overpass_url,
                          data=oql,
-                         headers=user_agent_headers())
+                         headers=user_agent_headers(),
+                         stream=stream)
 
-def run_query_persistent(oql, attempts=3, via_web=True):
+def save_query_persistent(oql, filename, attempts=3, via_web=True):
+    '''Run an Overpass query and stream the reply to filename, retrying on
+    timeout. Returns True once the reply is saved.'''
     for attempt in range(attempts):
         wait_for_slot()
         print('calling overpass')
-        r = run_query(oql)
+        r = run_query(oql, stream=True)
         if r is None:
             seconds = 30
             print('retrying, waiting {} seconds'.format(seconds))
             sleep(seconds)
             continue
-        if len(r.content) < 2000 and b'<remark> runtime error:' in r.content:
-
+        try:
+            save_reply(r, filename)
+        except OutOfMemory as e:
             msg = 'runtime error'
-            mail.error_mail(msg, oql, r, via_web=via_web)
+            mail.error_mail(msg, oql, r, via_web=via_web, reply=e.args[0])
             print(msg)
-            if b'<remark> runtime error: Query run out of memory' in r.content:
-                return
-            continue  # retry
-
-        if len(r.content) < 2000 and b'<title>504 Gateway' in r.content:
+            return
+        except Timeout as e:
             msg = 'overpass timeout'
-            mail.error_mail(msg, oql, r, via_web=via_web)
+            mail.error_mail(msg, oql, r, via_web=via_web, reply=e.args[0])
             print(msg)
             continue  # retry
 
-        return r
+        return True
+
+def check_start(start):
+    '''Overpass errors are short replies, so checking the start of a reply
+    is enough. Raises an exception if there is an error.'''
+    if b'<remark> runtime error: Query run out of memory' in start:
+        raise OutOfMemory(start)
+    if b'<remark> runtime error:' in start or b'<title>504 Gateway' in start:
+        raise Timeout(start)
+
+def check_reply(r):
+    '''Raise an exception if the Overpass reply is an error.'''
+    if r.status_code == 429:
+        raise RateLimited(r.content)
+    check_start(r.content[:error_check_size])
+    r.raise_for_status()
+
+def save_stream(chunks, filename, check=None):
+    '''Write chunks of bytes to a temporary file, then rename it to filename.
+
+    check is called with the start of the data before the rename, if it
+    raises an exception the temporary file is removed.'''
+    tmp_filename = filename + '.part'
+    start = b''
+    try:
+        with open(tmp_filename, 'wb') as f:
+            for chunk in chunks:
+                if len(start) < error_check_size:
+                    start += chunk[:error_check_size - len(start)]
+                f.write(chunk)
+        if check:
+            check(start)
+    except BaseException:
+        if os.path.exists(tmp_filename):  # open can fail before it exists
+            os.remove(tmp_filename)
+        raise
+    os.replace(tmp_filename, filename)
+
+def save_reply(r, filename):
+    '''Stream a streaming Overpass reply to filename.'''
+    try:
+        if r.status_code != 200:
+            check_reply(r)  # error replies are small enough to read
+        save_stream(r.iter_content(stream_chunk_size), filename, check=check_start)
+    finally:
+        r.close()
+
+def save_query(oql, filename):
+    '''Run an Overpass query and stream the reply to filename. The file only
+    exists once the download is complete.'''
+    save_reply(run_query(oql, stream=True), filename)
+
+def query_error_mail(oql, error):
+    '''Mail the reply for a failed query. Call this from the thread with the
+    app context, not from the workers in run_chunk_queries.'''
+    subject = {OutOfMemory: 'runtime error',
+               Timeout: 'overpass timeout',
+               RateLimited: 'overpass rate limit'}.get(type(error), 'overpass error')
+    reply = error.args[0] if error.args else ''
+    if isinstance(reply, bytes):
+        reply = reply.decode('utf-8', 'replace')
+    body = '''
+request data:
+{}
+
+error: {!r}
+
+reply:
+{}
+'''.format(oql, error, reply)
+    mail.send_mail(subject, body)
+
+def run_chunk_queries(queries, attempts=3, max_workers=4, no_retry=(OutOfMemory,)):
+    '''Save the reply for each (oql, filename) in queries. Queries run
+    concurrently, using as many as the Overpass server has free slots for.
+
+    Failed queries are retried on their own, unless the error is one of
+    no_retry. Returns a list of (oql, filename, exception) for queries that
+    failed.'''
+    pending = list(queries)
+    tries = defaultdict(int)
+    failed = []
+    running = {}
+    no_slot = 0  # passes in a row that found no free slot
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            if pending and len(running) < max_workers:
+                status = get_status()
+                free = min(status['free'], max_workers - len(running), len(pending))
+                for _ in range(free):
+                    oql, filename = pending.pop(0)
+                    print('calling overpass:', filename)
+                    running[executor.submit(save_query, oql, filename)] = (oql, filename)
+                if not running:
+                    wait_for_slot(status, attempt=no_slot)
+                    no_slot += 1
+                    continue
+                no_slot = 0
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                oql, filename = running.pop(future)
+                error = future.exception()
+                if not error:
+                    continue
+                tries[filename] += 1
+                print('error: {!r}, {}, attempt {}'.format(error, filename, tries[filename]))
+                if tries[filename] < attempts and not isinstance(error, no_retry):
+                    pending.append((oql, filename))
+                else:
+                    failed.append((oql, filename, error))
+
+    return failed
+
+def iter_osm_elements(filename):
+    '''Yields (type order, id, xml) for each node, way and relation in an
+    OSM XML file, without loading the whole file.'''
+    last = None
+    for event, element in etree.iterparse(filename, tag=tuple(osm_type_order)):
+        key = (osm_type_order[element.tag], int(element.get('id')))
+        if last is not None and key < last:
+            raise ValueError('{} is not sorted by type and id'.format(filename))
+        last = key
+        yield key + (etree.tostring(element, with_tail=False),)
+
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+def merge_osm_files(filenames, out_filename):
+    '''Merge OSM XML files from Overpass into one file, dropping elements
+    found in more than one of them.
+
+    Overpass writes nodes, then ways, then relations, each sorted by id, so
+    a streaming merge spots duplicates without keeping a set of ids.
+    Returns (elements written, duplicates removed).'''
+    counts = {'written': 0, 'duplicates': 0}
+
+    def chunks():
+        yield b"<?xml version='1.0' encoding='UTF-8'?>\n"
+        yield b'<osm version="0.6" generator="osm-wikidata merge">\n'
+        merged = heapq.merge(*[iter_osm_elements(f) for f in filenames])
+        last = None
+        for osm_type, osm_id, xml in merged:
+            if (osm_type, osm_id) == last:
+                counts['duplicates'] += 1
+                continue
+            last = (osm_type, osm_id)
+            counts['written'] += 1
+            yield xml + b'\n'
+        yield b'</osm>\n'
+
+    save_stream(chunks(), out_filename)
+    return counts['written'], counts['duplicates']
 
 def items_as_xml(items):
     assert items
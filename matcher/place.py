@@ -1,24 +1,28 @@
 from flask import current_app, url_for, g, abort
-from .model import Base, Item, ItemCandidate, PlaceItem, ItemTag, Changeset, osm_type_enum, get_bad
+from .model import Base, Item, ItemCandidate, PlaceItem, ItemTag, Changeset, WikipediaPage, osm_type_enum, get_bad
 from sqlalchemy.types import BigInteger, Float, Integer, JSON, String, DateTime
 from sqlalchemy.schema import Column
 from sqlalchemy import func, select, cast
 from sqlalchemy.orm import relationship, backref, column_property, object_session, deferred, load_only
 from geoalchemy2 import Geography, Geometry
 from sqlalchemy.ext.hybrid import hybrid_property
-from .database import session, get_tables
-from . import wikidata, matcher, wikipedia, overpass, utils
+from .database import session
+from . import wikidata, matcher, overpass, utils, loader, database
 from collections import Counter
 from .overpass import oql_from_tag
 
 import subprocess
+import math
 import os.path
 import re
 import shutil
-import time
 
 overpass_types = {'way': 'way', 'relation': 'rel', 'node': 'node'}
 
+default_chunk_max_items = 500
+default_chunk_max_area = 1024  # km², the same as a grid of 32 km squares
+max_chunk_depth = 12
+
 skip_tags = {'route:road',
              'highway=primary',
              'highway=road',
@@ -36,6 +40,27 @@ skip_tags = {'route:road',
              'addr:street',
              'type=associatedStreet'}
 
+def chunk_margin(points):
+    '''Degrees to pad a chunk so OSM objects within matching distance of the
+    items in it are downloaded.
+
+    The matcher measures distance in EPSG:3857 units, which are never longer
+    than a metre on the ground, so this is enough at any latitude.'''
+    max_dist = max(matcher.get_max_dist_from_criteria(tags) or matcher.default_max_dist
+                   for lat, lon, tags in points)
+    return math.degrees(max_dist * 1000 / loader.mercator_radius)
+
+def chunk_query(bbox, points, margin):
+    '''Padded bbox and tags for the Overpass query for one chunk, using the
+    tags of every item within the padded bbox, including items that belong to
+    neighbouring chunks.'''
+    query_bbox = utils.pad_bbox(bbox, margin)
+    tags = set()
+    for lat, lon, item_tags in utils.points_in_bbox(points, query_bbox):
+        tags |= set(item_tags)
+    tags.difference_update(skip_tags)
+    return query_bbox, matcher.simplify_tags(tags)
+
 class Place(Base):
     __tablename__ = 'place'
     place_id = Column(BigInteger, primary_key=True, autoincrement=False)
@@ -206,14 +231,7 @@ class Place(Base):
     def items_from_wikidata(self, bbox=None):
         if bbox is None:
             bbox = self.bbox
-        q = wikidata.get_enwiki_query(*bbox)
-        rows = wikidata.run_query(q)
-
-        items = wikidata.parse_enwiki_query(rows)
-
-        q = wikidata.get_item_tag_query(*bbox)
-        rows = wikidata.run_query(q)
-        wikidata.parse_item_tag_query(rows, items)
+        items = wikidata.get_items_in_bbox(*bbox)
 
         return {k: v
                 for k, v in items.items()
@@ -252,15 +270,17 @@ class Place(Base):
             return
         shutil.move(filename, self.overpass_backup)
 
+    def drop_tables(self):
+        if current_app.config.get('OSM_PARTITIONS'):
+            conn = session.bind.raw_connection()
+            loader.detach_place_tables(conn, self.prefix)
+            conn.close()
+        database.drop_place_tables(self.prefix)
+
     def clean_up(self):
         place_id = self.place_id
 
-        engine = session.bind
-        for t in get_tables():
-            if not t.startswith(self.prefix):
-                continue
-            engine.execute('drop table if exists {}'.format(t))
-        engine.execute('commit')
+        self.drop_tables()
 
         overpass_dir = current_app.config['OVERPASS_DIR']
         for f in os.listdir(overpass_dir):
@@ -335,6 +355,26 @@ class Place(Base):
         if os.stat(self.overpass_filename).st_size == 0:
             return 'no data from overpass to load with osm2pgsql'
 
+        max_elements = current_app.config.get('NATIVE_LOADER_MAX_ELEMENTS',
+                                              loader.default_max_elements)
+        osm = loader.read_osm_file(self.overpass_filename, max_elements) if max_elements else None
+        if osm is not None:  # small enough to load without osm2pgsql
+            conn = session.bind.raw_connection()
+            loader.load_osm(conn, self.prefix, *osm)
+            conn.close()
+        else:
+            error = self.run_osm2pgsql(capture_stderr=capture_stderr)
+            database.invalidate_table_cache(self.prefix)
+            if error:
+                return error
+
+        if current_app.config.get('OSM_PARTITIONS'):
+            conn = session.bind.raw_connection()
+            loader.attach_place_tables(conn, self.place_id, self.prefix)
+            conn.close()
+        database.invalidate_table_cache(self.prefix)
+
+    def run_osm2pgsql(self, capture_stderr=True):
         cmd = ['osm2pgsql', '--create', '--drop', '--slim',
                 '--hstore-all', '--hstore-add-index',
                 '--prefix', self.prefix,
@@ -348,6 +388,8 @@ class Place(Base):
         if not capture_stderr:
             p = subprocess.run(cmd,
                                env={'PGPASSWORD': current_app.config['DB_PASS']})
+            if p.returncode != 0:
+                return 'osm2pgsql failed'
             return
         p = subprocess.run(cmd,
                            stderr=subprocess.PIPE,
@@ -358,9 +400,9 @@ class Place(Base):
             else:
                 return p.stderr.decode('utf-8')
 
-    def save_overpass(self, content):
-        with open(self.overpass_filename, 'wb') as out:
-            out.write(content)
+    def save_overpass(self, chunks):
+        '''Save an Overpass reply, given as an iterable of chunks of bytes.'''
+        overpass.save_stream(chunks, self.overpass_filename)
 
     @property
     def all_tags(self):
@@ -479,8 +521,9 @@ class Place(Base):
 
         enwiki_to_item = {v['enwiki']: v for v in items.values() if 'enwiki' in v}
 
-        for title, cats in wikipedia.page_category_iter(enwiki_to_item.keys()):
-            enwiki_to_item[title]['categories'] = cats
+        for title, page in WikipediaPage.get_pages(enwiki_to_item.keys()).items():
+            if page.categories is not None:
+                enwiki_to_item[title]['categories'] = page.categories
 
         seen = set()
         for qid, v in items.items():
@@ -519,12 +562,14 @@ class Place(Base):
     def load_extracts(self, debug=False):
         by_title = {item.enwiki: item for item in self.items if item.enwiki}
 
-        for title, extract in wikipedia.get_extracts(by_title.keys()):
+        for title, page in WikipediaPage.get_pages(by_title.keys()).items():
+            if not page.extract:
+                continue
             item = by_title[title]
             if debug:
                 print(title)
-            item.extract = extract
-            item.extract_names = wikipedia.html_names(extract)
+            item.extract = page.extract
+            item.extract_names = page.extract_names
 
     def wbgetentities(self, debug=False):
         sub = (session.query(Item.item_id)
@@ -556,46 +601,33 @@ class Place(Base):
             return None
 
     def database_loaded(self):
-        tables = get_tables()
-        expect = [self.prefix + '_' + t for t in ('line', 'point', 'polygon')]
-        if not all(t in tables for t in expect):
-            return
+        return database.place_tables_exist(self.prefix)
 
-    def run_matcher(self, debug=False):
+    def run_matcher(self, debug=False, workers=None):
         conn = session.bind.raw_connection()
-        cur = conn.cursor()
 
         items = self.items.filter(Item.entity.isnot(None)).order_by(Item.item_id)
         if debug:
             print(items.count())
-        for item in items:
-            candidates = matcher.find_item_matches(cur, item, self.prefix, debug=False)
+
+        item_ids = []
+        candidates = []
+        matches = matcher.find_all_item_matches(conn, items, self.prefix, workers=workers)
+        for item, item_candidates in matches:
             if debug:
-                print(len(candidates), item.label())
-            as_set = {(i['osm_type'], i['osm_id']) for i in candidates}
-            for c in item.candidates[:]:
-                if (c.osm_type, c.osm_id) not in as_set:
-                    c.bad_matches.delete()
-                    session.delete(c)
-                    session.commit()
-
-            if not candidates:
-                continue
+                print(len(item_candidates), item.label())
+            item_ids.append(item.item_id)
+            candidates += [dict(i, item_id=item.item_id) for i in item_candidates]
+        conn.close()
 
-            for i in candidates:
-                c = ItemCandidate.query.get((item.item_id, i['osm_id'], i['osm_type']))
-                if not c:
-                    c = ItemCandidate(**i, item=item)
-                    session.add(c)
+        matcher.save_candidates(item_ids, candidates)
 
         self.state = 'ready'
         self.item_count = self.items.count()
         self.candidate_count = self.items_with_candidates_count()
         session.commit()
 
-        conn.close()
-
-    def do_match(self, debug=True):
+    def do_match(self, debug=True, workers=None):
         if self.state == 'ready':  # already done
             return
 
@@ -622,9 +654,8 @@ class Place(Base):
             print('loading_overpass')
             oql = self.get_oql()
             if self.area_in_sq_km < 800:
-                r = overpass.run_query_persistent(oql)
-                assert r
-                self.save_overpass(r.content)
+                saved = overpass.save_query_persistent(oql, self.overpass_filename)
+                assert saved
             else:
                 self.chunk()
             self.state = 'postgis'
@@ -638,7 +669,7 @@ class Place(Base):
 
         if self.state == 'osm2pgsql':
             print('run matcher')
-            self.run_matcher(debug=debug)
+            self.run_matcher(debug=debug, workers=workers)
             print('ready')
             self.state = 'ready'
             session.commit()
@@ -742,60 +773,86 @@ class Place(Base):
 
         return chunks
 
-    def chunk(self):
-        chunk_size = utils.calc_chunk_size(self.area_in_sq_km)
-        chunks = self.chunk_n(chunk_size)
+    def chunk_cells(self):
+        '''Split the place into cells sized by the number of items.'''
+        q = (self.items.outerjoin(ItemTag)
+                       .with_entities(Item.item_id,
+                                      func.ST_Y(cast(Item.location, Geometry)),
+                                      func.ST_X(cast(Item.location, Geometry)),
+                                      ItemTag.tag_or_key)
+                       .order_by(Item.item_id))
+        item_points = {}
+        for item_id, lat, lon, tag in q:
+            point = item_points.setdefault(item_id, (lat, lon, set()))
+            if tag:
+                point[2].add(tag)
+        points = list(item_points.values())
+
+        max_items = current_app.config.get('CHUNK_MAX_ITEMS', default_chunk_max_items)
+        max_area = current_app.config.get('CHUNK_MAX_AREA', default_chunk_max_area)
+        return utils.quadtree_chunks(self.bbox, points, max_items, max_area)
+
+    def chunk_oql(self, bbox, tags, include_self):
+        (ymin, ymax, xmin, xmax) = bbox
+        oql_bbox = '{:f},{:f},{:f},{:f}'.format(ymin, xmin, ymax, xmax)
 
-        print('chunk size:', chunk_size)
+        return overpass.oql_for_area(self.overpass_type,
+                                     self.osm_id,
+                                     tags,
+                                     oql_bbox, None,
+                                     include_self=include_self)
 
-        files = []
+    def chunk(self):
+        cells = self.chunk_cells()
+        print('chunks:', len(cells))
+        all_points = [point for path, bbox, points in cells for point in points]
+        margin = chunk_margin(all_points) if all_points else 0
 
-        need_pause = False
-        for chunk_num, (ymin, ymax, xmin, xmax) in enumerate(chunks):
-            q = self.items
-            # note: different order for coordinates, xmin first, not ymin
-            q = q.filter(cast(Item.location, Geometry).contained(func.ST_MakeEnvelope(xmin, ymin, xmax, ymax)))
-
-            tags = set()
-            for item in q:
-                tags |= set(item.tags)
-            tags.difference_update(skip_tags)
-            tags = matcher.simplify_tags(tags)
-            filename = '{}_{:03d}_{:03d}.xml'.format(self.place_id, chunk_num, len(chunks))
-            print(chunk_num, q.count(), len(tags), filename, list(tags))
-            full = os.path.join('overpass', filename)
-            if not(tags):
-                print('no tags, skipping')
-                continue
+        files = []
+        self_filename = None  # the query that includes the place itself
+        while cells:
+            queries = []
+            lookup = {}
+            for cell in cells:
+                path, bbox, points = cell
+                query_bbox, tags = chunk_query(bbox, all_points, margin)
+                filename = '{}_q{}.xml'.format(self.place_id, path)
+                print(path, len(points), len(tags), filename, list(tags))
+                full = os.path.join('overpass', filename)
+                if not(tags):
+                    print('no tags, skipping')
+                    continue
 
-            if not(tags):
-                continue
-            files.append(full)
-            if os.path.exists(full):
-                continue
+                files.append(full)
+                lookup[full] = cell
+                if self_filename is None:
+                    self_filename = full
+                if os.path.exists(full):
+                    continue
 
-            oql_bbox = '{:f},{:f},{:f},{:f}'.format(ymin, xmin, ymax, xmax)
-
-            if need_pause:
-                seconds = 2
-                print('waiting {:d} seconds'.format(seconds))
-                time.sleep(seconds)
-
-            oql = overpass.oql_for_area(self.overpass_type,
-                                        self.osm_id,
-                                        tags,
-                                        oql_bbox, None,
-                                        include_self=(chunk_num == 0))
-            r = overpass.run_query_persistent(oql)
-            if not r:
-                print(oql)
-            assert r
-            open(full, 'wb').write(r.content)
-            need_pause = True
-
-        cmd = ['osmium', 'merge'] + files + ['-o', self.overpass_filename]
-        print(' '.join(cmd))
-        subprocess.run(cmd)
+                oql = self.chunk_oql(query_bbox, tags, include_self=(full == self_filename))
+                queries.append((oql, full))
+
+            split_errors = (overpass.Timeout, overpass.OutOfMemory)
+            failed = overpass.run_chunk_queries(queries, no_retry=split_errors)
+            cells = []
+            for oql, filename, error in failed:
+                overpass.query_error_mail(oql, error)
+                cell = lookup[filename]
+                if not isinstance(error, split_errors) or len(cell[0]) >= max_chunk_depth:
+                    print(filename, repr(error))
+                    print(oql)
+                    raise error
+
+                print('splitting', filename, repr(error))
+                files.remove(filename)
+                if filename == self_filename:
+                    self_filename = None
+                cells += utils.split_cell(cell)
+
+        print('merging {} files'.format(len(files)))
+        written, duplicates = overpass.merge_osm_files(files, self.overpass_filename)
+        print('{} elements, {} duplicates removed'.format(written, duplicates))
 
 def get_top_existing(limit=30):
     cols = [Place.place_id, Place.display_name, Place.area, Place.state,
@@ -1,10 +1,18 @@
 from flask import current_app, request
 from itertools import islice
+from time import time
 import os.path
 import json
 import math
 import user_agents
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+earth_radius = 6371008.8  # mean radius in metres
+
 def chunk(it, size):
     it = iter(it)
     return iter(lambda: tuple(islice(it, size)), ())
@@ -40,6 +48,104 @@ def calc_chunk_size(area_in_sq_km):
     side = math.sqrt(area_in_sq_km)
     return math.ceil(side / 32)
 
+def element_coords(element):
+    '''(lat, lon) for an Overpass element, ways and relations use the center.'''
+    location = element.get('center', element)
+    return (location['lat'], location['lon'])
+
+def haversine_distances(lat, lon, points):
+    '''Distance in metres from (lat, lon) to each (lat, lon) in points.
+
+    Uses NumPy to compute every distance in one call when it is installed.'''
+    if not points:
+        return []
+    if numpy is None:
+        return [haversine(lat, lon, p_lat, p_lon) for p_lat, p_lon in points]
+
+    lat1, lon1 = numpy.radians(lat), numpy.radians(lon)
+    lat2, lon2 = numpy.radians(numpy.array(points, dtype=float)).T
+    a = (numpy.sin((lat2 - lat1) / 2) ** 2 +
+         numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin((lon2 - lon1) / 2) ** 2)
+    return (2 * earth_radius * numpy.arcsin(numpy.sqrt(a))).tolist()
+
+def haversine(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * earth_radius * math.asin(math.sqrt(a))
+
+def bbox_area_in_sq_km(bbox):
+    '''Area of a (south, north, west, east) bbox on a sphere.'''
+    south, north, west, east = map(math.radians, bbox)
+    radius = earth_radius / 1000
+    return radius ** 2 * (east - west) * (math.sin(north) - math.sin(south))
+
+def split_bbox(bbox):
+    '''Quarters of a (south, north, west, east) bbox.'''
+    south, north, west, east = bbox
+    mid_lat, mid_lon = (south + north) / 2, (west + east) / 2
+    return [
+        (south, mid_lat, west, mid_lon),
+        (south, mid_lat, mid_lon, east),
+        (mid_lat, north, west, mid_lon),
+        (mid_lat, north, mid_lon, east),
+    ]
+
+def pad_bbox(bbox, margin):
+    '''Grow a (south, north, west, east) bbox by margin degrees on every side.'''
+    south, north, west, east = bbox
+    return (max(south - margin, -90), min(north + margin, 90),
+            max(west - margin, -180), min(east + margin, 180))
+
+def points_in_bbox(points, bbox):
+    '''Points are (lat, lon, ...) tuples.'''
+    south, north, west, east = bbox
+    return [p for p in points if south <= p[0] <= north and west <= p[1] <= east]
+
+def bbox_tiles(bbox, max_area, max_depth=8):
+    '''Split a bbox into quarters until no tile covers more than max_area km².'''
+    tiles = [bbox]
+    for depth in range(max_depth):
+        if all(bbox_area_in_sq_km(tile) <= max_area for tile in tiles):
+            break
+        tiles = [quarter for tile in tiles
+                 for quarter in (split_bbox(tile)
+                                 if bbox_area_in_sq_km(tile) > max_area else [tile])]
+    return tiles
+
+def split_cell(cell):
+    '''Split a (path, bbox, points) cell into quarters, leaving out empty ones.
+    Points are (lat, lon, ...) tuples.'''
+    path, bbox, points = cell
+    mid_lat, mid_lon = (bbox[0] + bbox[1]) / 2, (bbox[2] + bbox[3]) / 2
+    quarters = split_bbox(bbox)
+    quarter_points = [[], [], [], []]
+    for point in points:
+        quarter_points[(point[0] >= mid_lat) * 2 + (point[1] >= mid_lon)].append(point)
+
+    return [(path + str(num), bbox, points)
+            for num, (bbox, points) in enumerate(zip(quarters, quarter_points))
+            if points]
+
+def quadtree_chunks(bbox, points, max_points, max_area, max_depth=8):
+    '''Split a bbox into cells with at most max_points points that cover no
+    more than max_area km², returns a list of (path, bbox, points).
+
+    Busy areas get small cells, cells without any points are left out.'''
+    if not points:
+        return []
+    pending = [('', bbox, points)]
+    cells = []
+    while pending:
+        cell = pending.pop(0)
+        path, cell_bbox, cell_points = cell
+        if len(path) >= max_depth or (len(cell_points) <= max_points and
+                                      bbox_area_in_sq_km(cell_bbox) <= max_area):
+            cells.append(cell)
+        else:
+            pending += split_cell(cell)
+    return sorted(cells)
+
 def file_missing_or_empty(filename):
     return (os.path.exists(filename) or
         os.stat(filename).st_size == 0)
@@ -47,3 +153,49 @@ def file_missing_or_empty(filename):
 def is_bot():
     ua = request.headers.get('User-Agent')
     return ua and user_agents.parse(ua).is_bot
+
+evict_interval = 60  # seconds between scans of a cache directory
+last_evict = {}  # cache directory -> time of the last scan
+
+class DiskCache(object):
+    '''Files in one directory, once they take up more than max_size bytes the
+    least recently used are removed. The modification time of a file records
+    when it was last used.'''
+    suffix = '.gz'
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+
+    def remove(self, filename):
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
+
+    def size(self):
+        return sum(f.stat().st_size for f in os.scandir(self.directory)
+                   if f.name.endswith(self.suffix))
+
+    def evict(self):
+        entries = []
+        for f in os.scandir(self.directory):
+            if not f.name.endswith(self.suffix):
+                continue
+            stat = f.stat()
+            entries.append((stat.st_mtime, stat.st_size, f.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, filename in sorted(entries):
+            if total <= self.max_size:
+                break
+            self.remove(filename)
+            total -= size
+
+    def evict_if_due(self):
+        '''Evict, scanning the directory at most once every evict_interval
+        seconds.'''
+        now = time()
+        if now - last_evict.get(self.directory, 0) >= evict_interval:
+            last_evict[self.directory] = now
+            self.evict()
@@ -1,9 +1,9 @@
 from . import database, nominatim, wikidata, matcher, user_agent_headers, overpass, mail
-from .utils import cache_filename, get_radius, get_int_arg, is_bot
+from .utils import cache_filename, get_radius, get_int_arg, is_bot, element_coords, haversine_distances
 from .model import Item, ItemCandidate, User, Category, Changeset, ItemTag, BadMatch, Timing, get_bad
 from .place import Place, get_top_existing
 from .taginfo import get_taginfo
-from .match import check_for_match
+from .match import check_for_match, NormalizedNames
 from .pager import Pagination, init_pager
 
 from flask import Flask, render_template, request, Response, redirect, url_for, g, jsonify, flash, abort
@@ -14,7 +14,6 @@ from sqlalchemy.orm.attributes import flag_modified
 from sqlalchemy.orm import load_only
 from sqlalchemy import func, distinct
 from werkzeug.exceptions import InternalServerError
-from geopy.distance import distance
 from jinja2 import evalcontextfilter, Markup, escape
 from time import time, sleep
 from dogpile.cache import make_region
@@ -25,7 +24,6 @@ from .matcher_view import matcher_blueprint
 import json
 import flask_assets
 import webassets.filter
-import operator
 import sys
 import requests
 import os.path
@@ -739,17 +737,10 @@ def refresh_place(osm_type, osm_id):
     place.move_overpass_to_backup()
     place.state = 'refresh'
 
-    engine = database.session.bind
-    for t in database.get_tables():
-        if not t.startswith(place.prefix):
-            continue
-        engine.execute('drop table if exists {}'.format(t))
-    engine.execute('commit')
+    place.drop_tables()
     database.session.commit()
 
-    expect = [place.prefix + '_' + t for t in ('line', 'point', 'polygon')]
-    tables = database.get_tables()
-    assert not any(t in tables for t in expect)
+    assert not database.get_place_tables(place.prefix)
 
     return redirect_to_matcher(place)
 
@@ -1011,14 +1002,15 @@ def api_item_match(wikidata_id):
             return api_overpass_error(data, 'overpass timeout')
 
         endings = matcher.get_ending_from_criteria({i.partition(':')[2] for i in criteria})
+        normalized_names = NormalizedNames(wikidata_names)
         found = [element for element in overpass_reply
-                 if check_for_match(element['tags'], wikidata_names, endings=endings)]
+                 if check_for_match(element['tags'], normalized_names, endings=endings)]
 
     osm = api_osm_list(existing, found)
 
-    for i in osm:
-        coords = operator.itemgetter('lat', 'lon')(i.get('center', i))
-        i['distance'] = int(distance(coords, (lat, lon)).m);
+    distances = haversine_distances(lat, lon, [element_coords(i) for i in osm])
+    for i, dist in zip(osm, distances):
+        i['distance'] = int(dist)
 
     data['response'] = 'ok'
     data['found_matches'] = bool(found)
@@ -1,14 +1,30 @@
-from flask import render_template_string
+from flask import render_template_string, current_app
 from urllib.parse import unquote
 from collections import defaultdict
-from .utils import chunk, drop_start, cache_filename
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from time import sleep, time
+from .utils import chunk, drop_start, cache_filename, split_bbox, bbox_tiles, bbox_area_in_sq_km, DiskCache
 from .language import get_language_label
-from . import user_agent_headers, overpass, mail, language, match, matcher
+from . import user_agent_headers, get_api_session, overpass, mail, language, match, matcher
 import requests
+import codecs
 import os
+import re
 import json
+import gzip
 
 page_size = 50
+wikidata_api_url = 'https://www.wikidata.org/w/api.php'
+default_concurrency = 4
+default_query_concurrency = 2  # parallel SPARQL queries for tiled bboxes
+max_tile_depth = 4  # times a tile that timed out can be split
+maxlag = 5  # seconds, https://www.mediawiki.org/wiki/Manual:Maxlag_parameter
+api_attempts = 5
+default_entity_max_age = 86400  # seconds before a stored entity is revalidated
+interactive_entity_max_age = 60  # seconds, for pages that show a single item
+default_entity_store_size = 1024 ** 3  # bytes
+location_cache_ttl = 3600  # seconds
+location_cache = {}  # P131 location QID -> (set of labels, expiry time)
 wd_entity = 'http://www.wikidata.org/entity/Q'
 enwiki = 'https://en.wikipedia.org/wiki/'
 skip_tags = {'route:road',
@@ -114,6 +130,38 @@ SELECT ?place ?placeLabel (SAMPLE(?location) AS ?location) ?address ?street ?ite
 GROUP BY ?place ?placeLabel ?address ?street ?item ?itemLabel ?tag
 '''
 
+# enwiki and OSM tag items in one pass: one row per place with the tags from
+# the subclass tree joined by GROUP_CONCAT, the article is optional
+wikidata_combined_query = '''
+SELECT ?place ?placeLabel (SAMPLE(?location) AS ?location) (SAMPLE(?article) AS ?article)
+       (SAMPLE(?address) AS ?address) (SAMPLE(?street) AS ?street)
+       (GROUP_CONCAT(DISTINCT ?tag; separator="|") AS ?tags) WHERE {
+    SERVICE wikibase:box {
+        ?place wdt:P625 ?location .
+        bd:serviceParam wikibase:cornerWest "Point({{ west }} {{ south }})"^^geo:wktLiteral .
+        bd:serviceParam wikibase:cornerEast "Point({{ east }} {{ north }})"^^geo:wktLiteral .
+    }
+    OPTIONAL {
+        ?article schema:about ?place .
+        ?article schema:inLanguage "en" .
+        ?article schema:isPartOf <https://en.wikipedia.org/> .
+        FILTER NOT EXISTS { ?place wdt:P31 wd:Q18340550 } .     # ignore timeline articles
+        FILTER NOT EXISTS { ?place wdt:P31 wd:Q13406463 } .     # ignore list articles
+    }
+    OPTIONAL {
+        ?place wdt:P31/wdt:P279* ?item .
+        ?item wdt:P1282 ?tag .
+        FILTER NOT EXISTS { ?item wdt:P31 wd:Q18340550 } .
+        FILTER NOT EXISTS { ?item wdt:P31 wd:Q13406463 } .
+    }
+    FILTER(BOUND(?article) || BOUND(?tag)) .
+    OPTIONAL { ?place wdt:P969 ?address } .
+    OPTIONAL { ?place wdt:P669 ?street } .
+    SERVICE wikibase:label { bd:serviceParam wikibase:language "en" }
+}
+GROUP BY ?place ?placeLabel
+'''
+
 # Q15893266 == former entity
 # Q56061 == administrative territorial entity
 
@@ -155,11 +203,23 @@ SELECT DISTINCT ?item ?itemLabel ?startLabel ?area WHERE {
 '''
 
 wikidata_query_api_url = 'https://query.wikidata.org/bigdata/namespace/wdq/sparql'
+query_chunk_size = 64 * 1024
+re_bindings_start = re.compile(r'"bindings"\s*:\s*\[')
+re_between_rows = re.compile(r'[\s,]*')
 
 class QueryError(Exception):
-    def __init__(self, query, r):
+    def __init__(self, query, r, reply=None):
         self.query = query
         self.r = r
+        self.reply = reply  # for streamed replies, r.text is no longer available
+
+class QueryTimeout(QueryError):
+    pass
+
+class APIError(Exception):
+    def __init__(self, params, r):
+        self.params = params
+        self.r = r
 
 def get_query(q, south, north, west, east):
     return render_template_string(q,
@@ -174,13 +234,88 @@ def get_enwiki_query(*args):
 def get_item_tag_query(*args):
     return get_query(wikidata_item_tags, *args)
 
+def get_combined_query(*args):
+    return get_query(wikidata_combined_query, *args)
+
 def get_point_query(lat, lon, radius):
     return render_template_string(wikidata_point_query,
                                   lat=lat,
                                   lon=lon,
                                   radius=float(radius) / 1000.0)
 
-def run_query(query, name=None):
+def is_query_timeout(r):
+    return r.status_code == 504 or 'java.util.concurrent.TimeoutException' in r.text
+
+def check_query_reply(query, r, send_mail=True):
+    if r.status_code == 200:
+        return
+    timeout = is_query_timeout(r)
+    if send_mail:
+        mail.error_mail('wikidata query error', query, r)
+    raise (QueryTimeout if timeout else QueryError)(query, r)
+
+def iter_bindings(chunks):
+    '''Yield the rows of a SPARQL JSON result from chunks of text as they
+    arrive, decoding one row at a time instead of the whole document.'''
+    chunks = iter(chunks)
+    decoder = json.JSONDecoder()
+    buf = ''
+    while True:
+        m = re_bindings_start.search(buf)
+        if m:
+            break
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise ValueError('no bindings in SPARQL result')
+        buf += chunk
+
+    pos = m.end()
+    while True:
+        pos = re_between_rows.match(buf, pos).end()
+        if pos < len(buf):
+            if buf[pos] == ']':
+                return
+            try:
+                row, pos = decoder.raw_decode(buf, pos)
+            except ValueError:  # row is split between chunks
+                pass
+            else:
+                yield row
+                continue
+
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise ValueError('truncated SPARQL result')
+        buf = buf[pos:] + chunk
+        pos = 0
+
+def run_query_stream(query, send_mail=True):
+    '''Run a SPARQL query, yielding binding rows while the response is
+    still downloading.'''
+    r = requests.get(wikidata_query_api_url,
+                     params={'query': query, 'format': 'json'},
+                     headers=user_agent_headers(),
+                     stream=True)
+    check_query_reply(query, r, send_mail)
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    last = ['']  # the end of the reply, for the error mail
+
+    def chunks():
+        for chunk in r.iter_content(query_chunk_size):
+            last[0] = decoder.decode(chunk)
+            yield last[0]
+
+    try:
+        yield from iter_bindings(chunks())
+    except ValueError:
+        # the status is sent before the query finishes, a query that times
+        # out gives a 200 reply that is cut short by a TimeoutException
+        error = QueryTimeout(query, r, reply=last[0])
+        if send_mail:
+            mail.error_mail('wikidata query error', query, r, reply=error.reply)
+        raise error
+
+def run_query(query, name=None, send_mail=True):
     if name:
         filename = cache_filename(name + '.json')
         if os.path.exists(filename):
@@ -189,9 +324,7 @@ def run_query(query, name=None):
     r = requests.get(wikidata_query_api_url,
                      params={'query': query, 'format': 'json'},
                      headers=user_agent_headers())
-    if r.status_code != 200:
-        mail.error_mail('wikidata query error', query, r)
-        raise QueryError(query, r)
+    check_query_reply(query, r, send_mail)
     if name:
         open(filename, 'wb').write(r.content)
     return r.json()['results']['bindings']
@@ -250,55 +383,314 @@ def parse_item_tag_query(rows, items):
                     items[qid][k] = row[k]['value']
         items[qid]['tags'].add(tag_or_key)
 
-def entity_iter(ids):
-    wikidata_url = 'https://www.wikidata.org/w/api.php'
-    params = {
-        'format': 'json',
-        'formatversion': 2,
-        'action': 'wbgetentities',
-    }
-    for cur in chunk(ids, page_size):
-        params['ids'] = '|'.join(cur)
-        r = requests.get(wikidata_url,
-                         params=params,
-                         headers=user_agent_headers())
-        r.raise_for_status()
-        json_data = r.json()
-        for qid, entity in json_data['entities'].items():
+def parse_combined_query(rows):
+    '''Build the same items dict as parse_enwiki_query followed by
+    parse_item_tag_query from the rows of the combined query.'''
+    items = {}
+    for row in rows:
+        tags = {drop_tag_prefix(tag) for tag in row['tags']['value'].split('|')}
+        tags = {tag for tag in tags if tag and tag not in skip_tags}
+        if 'article' not in row and not tags:
+            continue
+        item = {
+            'query_label': row['placeLabel']['value'],
+            'location': row['location']['value'],
+            'tags': tags,
+        }
+        if 'article' in row:
+            item['enwiki'] = enwiki_url_to_title(row['article']['value'])
+        for k in 'address', 'street':
+            if k in row:
+                item[k] = row[k]['value']
+        items[wd_uri_to_qid(row['place']['value'])] = item
+    return items
+
+def bbox_queries(bbox, combined):
+    if combined:
+        return [get_combined_query(*bbox)]
+    return [get_enwiki_query(*bbox), get_item_tag_query(*bbox)]
+
+def items_from_queries(queries, combined, send_mail=True):
+    if combined:
+        return parse_combined_query(run_query_stream(queries[0], send_mail))
+
+    enwiki_query, tag_query = queries
+    items = parse_enwiki_query(run_query_stream(enwiki_query, send_mail))
+    parse_item_tag_query(run_query_stream(tag_query, send_mail), items)
+    return items
+
+def merge_items(items, new_items):
+    '''Add items from another tile, the same item can be found in more than
+    one tile.'''
+    for qid, item in new_items.items():
+        if qid not in items:
+            items[qid] = item
+            continue
+        items[qid]['tags'] |= item['tags']
+        for k, v in item.items():
+            items[qid].setdefault(k, v)
+
+def get_items_tiled(bbox, tile_area, combined):
+    '''Run the queries for tiles covering no more than tile_area km², a few
+    at a time. A tile that times out is split into quarters that are tried
+    again.'''
+    concurrency = current_app.config.get('WIKIDATA_QUERY_CONCURRENCY',
+                                         default_query_concurrency)
+    items = {}
+    pending = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        def submit(tile, depth):
+            # render the queries here, templates need the app context
+            queries = bbox_queries(tile, combined)
+            future = executor.submit(items_from_queries, queries, combined, False)
+            pending[future] = (tile, depth)
+
+        for tile in bbox_tiles(bbox, tile_area):
+            submit(tile, 0)
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                tile, depth = pending.pop(future)
+                try:
+                    merge_items(items, future.result())
+                except QueryError as e:
+                    if isinstance(e, QueryTimeout) and depth < max_tile_depth:
+                        print('wikidata query timeout, splitting tile')
+                        for quarter in split_bbox(tile):
+                            submit(quarter, depth + 1)
+                        continue
+                    for f in pending:
+                        f.cancel()
+                    # mail from this thread, workers have no app context
+                    mail.error_mail('wikidata query error', e.query, e.r, reply=e.reply)
+                    raise
+    return items
+
+def get_items_in_bbox(south, north, west, east):
+    '''Items in a bounding box that have an English Wikipedia article or OSM
+    tags from their subclass tree.
+
+    With WIKIDATA_TILE_AREA set, bboxes bigger than that many km² are queried
+    in tiles.'''
+    bbox = (south, north, west, east)
+    config = current_app.config
+    combined = config.get('WIKIDATA_COMBINED_QUERY')
+    tile_area = config.get('WIKIDATA_TILE_AREA')
+    if tile_area and bbox_area_in_sq_km(bbox) > tile_area:
+        return get_items_tiled(bbox, tile_area, combined)
+    return items_from_queries(bbox_queries(bbox, combined), combined)
+
+def retry_after(r, attempt):
+    value = r.headers.get('Retry-After')
+    return int(value) if value and value.isdigit() else 5 * (attempt + 1)
+
+def api_get(params):
+    '''Call the Wikidata API, waiting and trying again when the servers are
+    lagged or ask us to slow down.'''
+    params = dict(params, format='json', formatversion=2, maxlag=maxlag)
+    for attempt in range(api_attempts):
+        r = get_api_session().get(wikidata_api_url, params=params)
+        if r.status_code == 200:
+            json_data = r.json()
+            if json_data.get('error', {}).get('code') != 'maxlag':
+                return json_data
+        elif r.status_code not in (429, 503):
+            r.raise_for_status()
+        seconds = retry_after(r, attempt)
+        print('wikidata API busy, waiting {} seconds'.format(seconds))
+        sleep(seconds)
+    raise APIError(params, r)
+
+def get_concurrency():
+    return current_app.config.get('WIKIDATA_CONCURRENCY', default_concurrency)
+
+def get_entity_batch(ids):
+    return api_get({'action': 'wbgetentities', 'ids': '|'.join(ids)})
+
+def get_revision_batch(ids):
+    return api_get({'action': 'query', 'prop': 'info', 'titles': '|'.join(ids)})
+
+def map_batches(func, ids, concurrency=None):
+    '''Call func with batches of IDs, in parallel when there is more than one
+    batch. Results come back in the same order as the batches, each one as
+    soon as it and the batches before it are complete.'''
+    if concurrency is None:
+        concurrency = get_concurrency()
+    batches = list(chunk(ids, page_size))
+    if concurrency > 1 and len(batches) > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            yield from executor.map(func, batches)
+        return
+
+    for cur in batches:
+        yield func(cur)
+
+def fetch_entities(ids, concurrency=None):
+    '''Yield (qid, entity) for every ID, downloaded with wbgetentities.'''
+    for json_data in map_batches(get_entity_batch, ids, concurrency):
+        yield from json_data['entities'].items()
+
+def latest_revisions(ids, concurrency=None):
+    '''Map QID to the current lastrevid. Missing items and redirects are left
+    out so they get downloaded again.'''
+    revisions = {}
+    for json_data in map_batches(get_revision_batch, ids, concurrency):
+        for page in json_data['query']['pages']:
+            if 'missing' in page or 'redirect' in page:
+                continue
+            revisions[page['title']] = page['lastrevid']
+    return revisions
+
+class EntityStore(DiskCache):
+    '''Wikidata entities stored as gzip compressed JSON on disk, keyed by QID.
+
+    Each entry records the lastrevid and when it was fetched. The
+    modification time of a file is when the revision was last confirmed as
+    current, entries older than max_age are checked against the latest
+    revision before use. Once the store is bigger than max_size the entries
+    that were confirmed longest ago are removed.'''
+
+    suffix = '.json.gz'
+
+    def __init__(self, directory, max_age=default_entity_max_age,
+                 max_size=default_entity_store_size):
+        super().__init__(directory, max_size)
+        self.max_age = max_age
+
+    def filename(self, qid):
+        return os.path.join(self.directory, qid + self.suffix)
+
+    def load(self, qid):
+        filename = self.filename(qid)
+        try:
+            with gzip.open(filename, 'rt', encoding='utf-8') as f:
+                entry = json.load(f)
+            entry['checked'] = os.stat(filename).st_mtime
+        except FileNotFoundError:
+            return
+        except (OSError, EOFError, ValueError):  # damaged entry
+            self.remove(filename)
+            return
+        return entry
+
+    def save(self, qid, entity):
+        os.makedirs(self.directory, exist_ok=True)
+        entry = {
+            'qid': qid,
+            'lastrevid': entity['lastrevid'],
+            'fetched': time(),
+            'entity': entity,
+        }
+        filename = self.filename(qid)
+        tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+        with gzip.open(tmp_filename, 'wt', encoding='utf-8') as f:
+            json.dump(entry, f)
+        os.replace(tmp_filename, filename)
+
+        self.evict_if_due()
+
+    def iter_entities(self, ids, concurrency=None, max_age=None):
+        '''Yield (qid, entity) for every ID, only downloading entities that
+        are missing from the store or have been edited since they were saved.
+        max_age overrides the age at which an entry is revalidated.
+
+        Fresh entries come first, then each batch as it is downloaded.'''
+        if max_age is None:
+            max_age = self.max_age
+        stale, fetch = [], []
+        now = time()
+        for qid in ids:
+            entry = self.load(qid)
+            if entry is None:
+                fetch.append(qid)
+            elif now - entry['checked'] < max_age:
+                yield qid, entry['entity']
+            else:
+                stale.append(entry)
+
+        if stale:
+            revisions = latest_revisions([entry['qid'] for entry in stale], concurrency)
+            for entry in stale:
+                qid = entry['qid']
+                if revisions.get(qid) != entry['lastrevid']:
+                    fetch.append(qid)
+                    continue
+                try:
+                    os.utime(self.filename(qid))
+                except FileNotFoundError:  # evicted, save it again
+                    self.save(qid, entry['entity'])
+                yield qid, entry['entity']
+
+        for qid, entity in fetch_entities(fetch, concurrency):
+            if 'missing' not in entity:
+                self.save(qid, entity)
             yield qid, entity
 
+    def get_entities(self, ids, concurrency=None, max_age=None):
+        '''Map QID to entity.'''
+        return dict(self.iter_entities(ids, concurrency, max_age))
+
+def get_entity_store():
+    config = current_app.config
+    return EntityStore(os.path.join(config['CACHE_DIR'], 'entities'),
+                       max_age=config.get('WIKIDATA_ENTITY_MAX_AGE',
+                                          default_entity_max_age),
+                       max_size=config.get('WIKIDATA_ENTITY_STORE_SIZE',
+                                           default_entity_store_size))
+
+def entity_iter(ids, concurrency=None, store=None):
+    '''Yield (qid, entity) for every ID as soon as it is available. Entities
+    already in the store come first, then downloaded entities in the same
+    order as the IDs.'''
+    if store is None:
+        store = get_entity_store()
+    yield from store.iter_entities(ids, concurrency)
+
 def get_entity(qid):
-    wikidata_url = 'https://www.wikidata.org/w/api.php'
-    params = {
-        'format': 'json',
-        'formatversion': 2,
-        'action': 'wbgetentities',
-        'ids': qid,
-    }
-    json_data = requests.get(wikidata_url,
-                             params=params,
-                             headers=user_agent_headers()).json()
-    try:
-        entity = list(json_data['entities'].values())[0]
-    except KeyError:
-        return None
-    if 'missing' not in entity:
+    # the page for an item should show edits made on Wikidata, revalidating
+    # is one cheap lastrevid request
+    store = get_entity_store()
+    entity = store.get_entities([qid], max_age=interactive_entity_max_age).get(qid)
+    if entity and 'missing' not in entity:
         return entity
 
 def get_entities(ids):
     if not ids:
         return []
-    wikidata_url = 'https://www.wikidata.org/w/api.php'
-    params = {
-        'format': 'json',
-        'formatversion': 2,
-        'action': 'wbgetentities',
-        'ids': '|'.join(ids),
-    }
-    json_data = requests.get(wikidata_url,
-                             params=params,
-                             headers=user_agent_headers()).json()
-    return list(json_data['entities'].values())
+    return [entity for qid, entity in entity_iter(ids)]
+
+def located_in(entity):
+    '''QIDs of the P131 (located in) values of an entity.'''
+    return [claim['mainsnak']['datavalue']['value']['id']
+            for claim in entity.get('claims', {}).get('P131', [])
+            if 'datavalue' in claim['mainsnak']]
+
+def location_labels(qids):
+    '''Map location QID to the set of its labels.
+
+    Labels are kept in a process wide cache for location_cache_ttl seconds,
+    only locations that are missing or expired are fetched.'''
+    now = time()
+    found, missing = {}, []
+    for qid in set(qids):
+        cached = location_cache.get(qid)
+        if cached and cached[1] > now:
+            found[qid] = cached[0]
+        else:
+            missing.append(qid)
+    if not missing:
+        return found
+
+    # other request threads can be expiring the same entries
+    for qid, (labels, expires) in list(location_cache.items()):
+        if expires <= now:
+            location_cache.pop(qid, None)
+    for qid, entity in entity_iter(sorted(missing)):
+        labels = {v['value'] for v in entity.get('labels', {}).values()}
+        location_cache[qid] = (labels, now + location_cache_ttl)
+        found[qid] = labels
+    return found
 
 def names_from_entity(entity, skip_lang=None):
     if skip_lang is None:
@@ -483,13 +875,8 @@ class WikidataItem:
             return
 
         location_names = set()
-        located_in = [i['mainsnak']['datavalue']['value']['id']
-                      for i in self.entity['claims']['P131']]
-
-        for location in get_entities(located_in):
-            location_names |= {v['value']
-                               for v in location['labels'].values()
-                               if v['value'] not in wikidata_names}
+        for labels in location_labels(located_in(self.entity)).values():
+            location_names |= {label for label in labels if label not in wikidata_names}
 
         for name_key, name_values in list(wikidata_names.items()):
             for n in location_names:
@@ -587,6 +974,7 @@ SELECT DISTINCT ?code WHERE {
         wikidata_names = self.names
         self.trim_location_from_names(wikidata_names)
         endings = matcher.get_ending_from_criteria({i.partition(':')[2] for i in criteria})
+        wikidata_names = match.NormalizedNames(wikidata_names)
 
         found = []
         for element in overpass_reply:
@@ -1,27 +1,41 @@
-import requests
 import lxml.html
 import simplejson
+from flask import current_app
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
 from .utils import chunk, drop_start
-from . import user_agent_headers, mail
+from . import get_api_session, mail
 
 page_size = 50
 extracts_page_size = 20
 query_url = 'https://{}.wikipedia.org/w/api.php'
+default_concurrency = 4
+default_cache_max_age = 86400  # seconds before a cached page is revalidated
+category_params = {'prop': 'categories', 'cllimit': 'max', 'clshow': '!hidden'}
 
+class QueryError(Exception):
+    def __init__(self, params, r):
+        self.params = params
+        self.r = r
 
-def run_query(titles, params, language_code='en'):
-    base = {
-        'format': 'json',
-        'formatversion': 2,
-        'action': 'query',
-        'continue': '',
-        'titles': '|'.join(titles),
-    }
-    p = base.copy()
-    p.update(params)
+def get_concurrency():
+    return current_app.config.get('WIKIPEDIA_CONCURRENCY', default_concurrency)
+
+def get_cache_max_age():
+    return current_app.config.get('WIKIPEDIA_CACHE_MAX_AGE', default_cache_max_age)
+
+def merge_page(pages, page):
+    '''Combine the parts of a page returned by continued queries.'''
+    existing = pages.setdefault(page['title'], {})
+    for key, value in page.items():
+        if isinstance(value, list):
+            existing.setdefault(key, []).extend(value)
+        else:
+            existing.setdefault(key, value)
 
+def api_get(p, language_code='en'):
     url = query_url.format(language_code)
-    r = requests.get(url, params=p, headers=user_agent_headers())
+    r = get_api_session().get(url, params=p)
     expect = 'application/json; charset=utf-8'
     success = True
     if r.status_code != 200:
@@ -31,36 +45,67 @@ def run_query(titles, params, language_code='en'):
         print('content-type: {r.headers[content-type]}'.format(r=r))
         success = False
     if not success:
-        mail.error_mail('wikipedia error', p, r)
-    assert success
-    json_reply = r.json()
-    return json_reply['query']['pages']
+        raise QueryError(p, r)
+    return r.json()
+
+def run_query(titles, params, language_code='en'):
+    '''Run a query for a batch of titles, following continue tokens until
+    the reply is complete.'''
+    base = {
+        'format': 'json',
+        'formatversion': 2,
+        'action': 'query',
+        'titles': '|'.join(titles),
+    }
+    base.update(params)
+
+    pages = {}
+    cont = {'continue': ''}
+    while cont:
+        json_reply = api_get(dict(base, **cont), language_code)
+        for page in json_reply['query']['pages']:
+            merge_page(pages, page)
+        cont = json_reply.get('continue')
+    return list(pages.values())
+
+def batch_iter(query, titles, size, concurrency=None):
+    '''Run query over batches of titles with a bounded number of requests
+    at once, yielding pages as each batch completes.'''
+    if concurrency is None:
+        concurrency = get_concurrency()
+    batches = list(chunk(titles, size))
+    try:
+        if concurrency > 1 and len(batches) > 1:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                futures = [executor.submit(query, cur) for cur in batches]
+                for future in as_completed(futures):
+                    yield from future.result()
+            return
+
+        for cur in batches:
+            yield from query(cur)
+    except QueryError as e:  # mail from this thread, workers have no app context
+        mail.error_mail('wikipedia error', e.params, e.r)
+        raise
 
 def get_cats(titles, language_code='en'):
-    params = {'prop': 'categories', 'cllimit': 'max', 'clshow': '!hidden'}
-    return run_query(titles, params, language_code)
+    return run_query(titles, category_params, language_code)
 
 def get_coords(titles, language_code='en'):
     return run_query(titles, {'prop': 'coordinates'}, language_code)
 
-def page_category_iter(titles):
-    for cur in chunk(titles, page_size):
-        for page in get_cats(cur):
-            if 'categories' not in page:  # redirects
-                continue
-            cats = [drop_start(cat['title'], 'Category:')
-                    for cat in page['categories']]
-            yield (page['title'], cats)
+def page_category_iter(titles, concurrency=None):
+    for page in batch_iter(get_cats, titles, page_size, concurrency):
+        if 'categories' not in page:  # redirects
+            continue
+        cats = [drop_start(cat['title'], 'Category:')
+                for cat in page['categories']]
+        yield (page['title'], cats)
 
 def get_items_with_cats(items):
     assert isinstance(items, dict)
-    for cur in chunk(items.keys(), page_size):
-        for page in get_cats(cur):
-            if 'categories' not in page:  # redirects
-                continue
-            cats = [drop_start(cat['title'], 'Category:')
-                    for cat in page['categories']]
-            items[page['title']]['cats'] = cats
+    for title, cats in page_category_iter(items.keys()):
+        items[title]['cats'] = cats
 
 def html_names(article):
     if article.strip() == '':
@@ -78,12 +123,39 @@ def extracts_query(titles, language_code='en'):
     }
     return run_query(titles, params, language_code)
 
-def get_extracts(titles):
-    for cur in chunk(titles, extracts_page_size):
-        for page in extracts_query(cur):
-            if 'extract' not in page:
-                continue
-            extract = page['extract'].strip()
-            if extract:
-                yield (page['title'], page['extract'])
+def get_extracts(titles, concurrency=None):
+    for page in batch_iter(extracts_query, titles, extracts_page_size, concurrency):
+        if 'extract' not in page:
+            continue
+        extract = page['extract'].strip()
+        if extract:
+            yield (page['title'], page['extract'])
+
+
+def latest_revisions(titles, language_code='en', concurrency=None):
+    '''Map title to the lastrevid of every page that exists.'''
+    query = partial(run_query, params={'prop': 'info'}, language_code=language_code)
+    return {page['title']: page['lastrevid']
+            for page in batch_iter(query, titles, page_size, concurrency)
+            if 'lastrevid' in page}
+
+def fetch_pages(titles, language_code='en', concurrency=None):
+    '''Map title to the lastrevid, categories and intro extract of every page
+    that exists. Categories are None for redirects.'''
+    params = dict(category_params, prop='categories|info')
+    query = partial(run_query, params=params, language_code=language_code)
+    pages = {}
+    for page in batch_iter(query, titles, page_size, concurrency):
+        if 'lastrevid' not in page:  # missing page
+            continue
+        cats = ([drop_start(cat['title'], 'Category:') for cat in page['categories']]
+                if 'categories' in page else None)
+        pages[page['title']] = {'lastrevid': page['lastrevid'],
+                                'categories': cats,
+                                'extract': None}
 
+    query = partial(extracts_query, language_code=language_code)
+    for page in batch_iter(query, list(pages), extracts_page_size, concurrency):
+        if page['title'] in pages and page.get('extract', '').strip():
+            pages[page['title']]['extract'] = page['extract']
+    return pages
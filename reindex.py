@@ -1,10 +1,9 @@
 #!/usr/bin/python3
 from matcher.model import Place, Item, ItemCandidate
-from matcher import database, user_agent_headers, matcher, wikidata
+from matcher import database, matcher, wikidata, overpass
 from matcher.view import app
 from matcher.overpass import wait_for_slot, get_status  # noqa: F401
 from time import sleep
-import requests
 import sys
 
 def do_reindex(place, force=False):
@@ -41,19 +40,14 @@ def do_reindex(place, force=False):
     print(sorted(all_tags))
     sleep(10)
 
-    tables = database.get_tables()
-    expect = [place.prefix + '_' + t for t in ('line', 'point', 'polygon')]
-    if not all(t in tables for t in expect) or place.all_tags != all_tags:
+    if not database.place_tables_exist(place.prefix) or place.all_tags != all_tags:
         if not place.overpass_done:
             oql = place.get_oql()
-            overpass_url = 'https://overpass-api.de/api/interpreter'
 
             wait_for_slot()
             print('running overpass query')
-            r = requests.post(overpass_url, data=oql, headers=user_agent_headers())
+            overpass.save_query(oql, place.overpass_filename)
             print('overpass done')
-
-            place.save_overpass(r.content)
         place.state = 'postgis'
         database.session.commit()
 
@@ -63,11 +57,9 @@ def do_reindex(place, force=False):
         database.session.commit()
 
     conn = database.session.bind.raw_connection()
-    cur = conn.cursor()
 
     q = place.items.filter(Item.entity.isnot(None)).order_by(Item.item_id)
-    for item in q:
-        candidates = matcher.find_item_matches(cur, item, place.prefix, debug=False)
+    for item, candidates in matcher.find_all_item_matches(conn, q, place.prefix):
         for i in (candidates or []):
             c = ItemCandidate.query.get((item.item_id, i['osm_id'], i['osm_type']))
             if not c:
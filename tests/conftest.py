@@ -1,6 +1,7 @@
 import pytest
 from flask import Flask
 from testing.postgresql import Postgresql
+from matcher import wikidata  # noqa: F401, imported first to avoid a circular import
 from matcher import database
 from matcher.place import Place  # noqa: F401
 from matcher.model import Base, Item  # noqa: F401
@@ -36,8 +37,48 @@ def app(request, postgresql):
     # create database tables
     engine = database.session.get_bind()
     engine.execute('create extension postgis')
+    engine.execute('create extension hstore')
+    engine.dispose()  # new connections register the hstore type
     Base.metadata.create_all(engine)
 
     yield app
 
     ctx.pop()
+
+class FakeResponse:
+    def __init__(self, json_data, status_code=200, headers=None):
+        self.json_data = json_data
+        self.status_code = status_code
+        self.headers = {'content-type': 'application/json; charset=utf-8'}
+        self.headers.update(headers or {})
+
+    def json(self):
+        return self.json_data
+
+    def raise_for_status(self):
+        assert self.status_code == 200
+
+class FakeSession:
+    '''Stands in for the shared API session. Queued replies are sent first,
+    then reply(params) is called to build one from the request.'''
+    def __init__(self):
+        self.calls = []
+        self.replies = []
+        self.reply = None
+        self.status_code = 200
+
+    def queue(self, json_data, status_code=200, headers=None):
+        self.replies.append(FakeResponse(json_data, status_code, headers))
+
+    def get(self, url, params=None):
+        self.calls.append(params)
+        if self.replies:
+            return self.replies.pop(0)
+        return FakeResponse(self.reply(params), self.status_code)
+
+@pytest.fixture
+def api_session(monkeypatch):
+    '''Fake session for the Wikidata and Wikipedia APIs.'''
+    session = FakeSession()
+    monkeypatch.setattr('matcher.api_session', session)
+    return session
@@ -0,0 +1,19 @@
+from matcher import database
+
+def test_place_tables(app):
+    engine = database.session.bind
+    assert not database.place_tables_exist('osm_1')
+
+    for t in database.osm_table_types:
+        engine.execute('create table osm_1_{} (osm_id bigint)'.format(t))
+    engine.execute('create table osm_12_point (osm_id bigint)')
+    engine.execute('commit')
+
+    assert not database.place_tables_exist('osm_1')  # cached
+    database.invalidate_table_cache('osm_1')
+    assert database.place_tables_exist('osm_1')
+    assert sorted(database.get_place_tables('osm_1')) == ['osm_1_line', 'osm_1_point', 'osm_1_polygon']
+
+    database.drop_place_tables('osm_1')
+    assert not database.place_tables_exist('osm_1')
+    assert database.get_place_tables('osm_12') == ['osm_12_point']
@@ -0,0 +1,124 @@
+from matcher import loader, matcher, database
+from matcher.model import Item
+
+osm_xml = '''<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6" generator="Overpass API">
+  <node id="1" lat="52.0" lon="0.0"><tag k="name" v="Mill &quot;Road&quot;"/><tag k="amenity" v="pub"/></node>
+  <node id="2" lat="52.0" lon="0.001"/>
+  <node id="3" lat="52.001" lon="0.001"/>
+  <node id="4" lat="52.001" lon="0.0"/>
+  <way id="10"><nd ref="1"/><nd ref="2"/><nd ref="3"/><nd ref="4"/><nd ref="1"/><tag k="building" v="yes"/></way>
+  <way id="11"><nd ref="1"/><nd ref="2"/><tag k="highway" v="footway"/></way>
+  <way id="12"><nd ref="2"/><nd ref="3"/><nd ref="4"/><nd ref="2"/></way>
+  <relation id="5"><member type="way" ref="12" role="outer"/><tag k="type" v="multipolygon"/><tag k="landuse" v="grass"/></relation>
+  <relation id="6"><member type="way" ref="12" role="outer"/><tag k="type" v="site"/><tag k="name" v="Site"/></relation>
+</osm>'''
+
+def test_read_osm_file(tmp_path):
+    filename = tmp_path / 'place.xml'
+    filename.write_text(osm_xml)
+
+    nodes, ways, relations = loader.read_osm_file(str(filename))
+    assert len(nodes) == 4 and len(ways) == 3 and len(relations) == 2
+    assert nodes[1][2] == {'name': 'Mill "Road"', 'amenity': 'pub'}
+    assert ways[11] == ([1, 2], {'highway': 'footway'})
+    assert relations[5][0] == [('way', 12, 'outer')]
+
+    assert loader.read_osm_file(str(filename), max_elements=5) is None
+
+def test_osm_rows(tmp_path):
+    filename = tmp_path / 'place.xml'
+    filename.write_text(osm_xml)
+    rows = loader.osm_rows(*loader.read_osm_file(str(filename)))
+
+    assert [row[0] for row in rows['point']] == [1]
+    assert rows['point'][0][2].startswith('POINT(0.00 6800125.')
+    assert [row[0] for row in rows['line']] == [11]
+    assert [row[0] for row in rows['polygon']] == [10, -5]
+    assert rows['polygon'][0][2].startswith('POLYGON((')
+    assert rows['polygon'][1][2].startswith('MULTILINESTRING((')
+
+def test_copy_data():
+    rows = [(1, {'name': 'a\tb', 'note': 'x"y\\z'}, 'POINT(1 2)'),
+            (2, {'amenity': 'pub'}, 'POINT(3 4)')]
+    assert loader.copy_data(rows).getvalue() == (
+        '1\ta\\tb\t"name"=>"a\\tb","note"=>"x\\\\"y\\\\\\\\z"\tSRID=3857;POINT(1 2)\n'
+        '2\t\\N\t"amenity"=>"pub"\tSRID=3857;POINT(3 4)\n')
+
+def test_load_osm(app, tmp_path):
+    filename = tmp_path / 'place.xml'
+    filename.write_text(osm_xml)
+    conn = database.session.bind.raw_connection()
+    loader.load_osm(conn, 'osm_99', *loader.read_osm_file(str(filename)))
+
+    cur = conn.cursor()
+    found = {}
+    for table in loader.osm_tables:
+        cur.execute('select osm_id, name, tags, ST_GeometryType(way), ST_SRID(way) '
+                    'from osm_99_{} order by osm_id desc'.format(table))
+        found[table] = cur.fetchall()
+
+    assert found['point'] == [(1, 'Mill "Road"', {'name': 'Mill "Road"', 'amenity': 'pub'},
+                               'ST_Point', 3857)]
+    assert found['line'] == [(11, None, {'highway': 'footway'}, 'ST_LineString', 3857)]
+    assert [(row[0], row[3]) for row in found['polygon']] == [(10, 'ST_Polygon'),
+                                                              (-5, 'ST_Polygon')]
+    cur.execute('select bool_and(way_area > 0) from osm_99_polygon')
+    assert cur.fetchone()[0]
+
+    # the matcher query runs against the loaded tables like osm2pgsql output
+    item = Item(item_id=200,
+                tags={'amenity=pub'},
+                location='Point(0.0 52.0)',
+                entity={'labels': {'en': {'language': 'en', 'value': 'Mill "Road"'}},
+                        'sitelinks': {}})
+    database.session.add(item)
+    database.session.commit()
+
+    candidates = matcher.find_item_matches(cur, item, 'osm_99')
+    assert [(c['osm_type'], c['osm_id'], c['planet_table']) for c in candidates] == [
+        ('node', 1, 'point')]
+    assert candidates[0]['dist'] < 1
+    conn.close()
+
+def test_attach_place_tables(app, tmp_path):
+    filename = tmp_path / 'place.xml'
+    filename.write_text(osm_xml)
+    conn = database.session.bind.raw_connection()
+    loader.load_osm(conn, 'osm_98', *loader.read_osm_file(str(filename)))
+    cur = conn.cursor()
+    # osm2pgsql tables have more columns than the matcher uses
+    cur.execute('alter table osm_98_point add column z_order integer')
+    cur.execute('create table osm_98_roads (osm_id bigint)')
+    conn.commit()
+
+    def relfilenodes():
+        cur.execute("select relname, relfilenode from pg_class "
+                    "where relname like 'osm\\_98\\_%' and relkind = 'r'")
+        return dict(cur.fetchall())
+    before = relfilenodes()
+
+    loader.attach_place_tables(conn, 98, 'osm_98')
+
+    # attaching doesn't copy or rewrite the tables
+    after = relfilenodes()
+    assert after == {name: node for name, node in before.items() if name != 'osm_98_roads'}
+    assert loader.table_columns(cur, 'osm_98_point') == ['osm_id', 'name', 'tags', 'way',
+                                                         'place_id']
+    for table in loader.osm_tables:
+        assert loader.partition_parent(cur, 'osm_98_' + table) == 'osm_' + table
+
+    cur.execute('select osm_id from osm_polygon where place_id = 98 order by osm_id')
+    assert [row[0] for row in cur.fetchall()] == [-5, 10]
+    cur.execute('select place_id, osm_id from osm_98_point')
+    assert cur.fetchall() == [(98, 1)]
+
+    loader.detach_place_tables(conn, 'osm_98')
+    for table in loader.osm_tables:
+        assert loader.partition_parent(cur, 'osm_98_' + table) is None
+    cur.execute('select count(*) from osm_point')
+    assert cur.fetchone()[0] == 0
+    conn.close()
+
+    database.drop_place_tables('osm_98')
+    assert not database.get_place_tables('osm_98')
@@ -1,4 +1,15 @@
-from matcher.match import tidy_name, match_with_words_removed, initials_match, MatchType
+from matcher.match import (tidy_name, match_with_words_removed, initials_match, MatchType,
+                           NormalizedName, NormalizedNames, name_match, get_names,
+                           check_for_match, get_all_matches)
+from itertools import combinations
+
+# names and endings from the tests above, plus variants that reach each branch
+# of name_match_main
+parity_names = ['no change', "saint andrew's", "St Andrew's", 'norwich bus station',
+                'norwich', 'Norwich', 'The Norwich', 'Norwich, Norfolk', 'TIAT',
+                'This Is A Test', 'T.I.A.T.', 'TIAT station', 'Test Is A This',
+                'Statue of Norwich', 'Norwich Building']
+parity_endings = [None, ['test'], ['bus station'], ['station']]
 
 def test_tidy_name():
     same = 'no change'
@@ -26,3 +37,48 @@ def test_initials_match():
     assert initials_match(n1, n2)
 
     assert not initials_match('bad', 'Bad Match Here')
+
+def test_normalized_names_lookup():
+    names = NormalizedNames({'The Eiffel Tower': [('label', 'en')],
+                             'Tour Eiffel, Paris': [('label', 'fr')]})
+    assert len(names) == 2
+
+    osm = NormalizedName('Eiffel Tower')
+    assert osm.the_stripped == 'eiffeltower'
+    assert names.lookup(osm) == {0}
+    assert names.lookup(NormalizedName('tour eiffel')) == {1}
+    assert names.lookup(NormalizedName('Paris')) == set()
+
+def pairwise_matches(osm_tags, wikidata_names, endings=None):
+    '''Every pair through name_match, as check_for_match worked before the
+    hash lookup fast path.'''
+    matches = []
+    for w, source in wikidata_names.items():
+        for osm_key, o in get_names(osm_tags).items():
+            m = name_match(o, w, endings)
+            if m:
+                matches.append((m.match_type, w, source, o, osm_key))
+    return matches
+
+def match_detail(m):
+    if m:
+        return (m.match_type, m.wikidata_name, m.wikidata_source, m.osm_name, m.osm_key)
+
+def test_fast_path_parity():
+    osm_tag_list = [{'name': n} for n in parity_names]
+    osm_tag_list += [{'name': a, 'alt_name': b} for a, b in zip(parity_names, parity_names[1:])]
+
+    for endings in parity_endings:
+        for wd_pair in combinations(parity_names, 2):
+            wikidata_names = {n: [('label', str(num))] for num, n in enumerate(wd_pair)}
+            normalized = NormalizedNames(wikidata_names)
+            for osm_tags in osm_tag_list:
+                expect = pairwise_matches(osm_tags, wikidata_names, endings)
+                found = get_all_matches(osm_tags, normalized, endings)
+                assert [match_detail(m) for m in found] == expect
+
+                good = [m for m in expect if m[0] == MatchType.good]
+                trim = [m for m in expect if m[0] == MatchType.trim]
+                expect_best = good[0] if good else (trim[-1] if trim else None)
+                found = check_for_match(osm_tags, normalized, endings)
+                assert match_detail(found) == expect_best
@@ -0,0 +1,148 @@
+from matcher import matcher
+import os.path
+import random
+import json
+import re
+
+entity_types_filename = os.path.join(os.path.dirname(__file__), '..', 'data', 'entity_types.json')
+
+def load_entity_types():
+    return json.load(open(entity_types_filename))
+
+def old_categories_to_tags(categories, cat_to_entity):
+    '''categories_to_tags before CategoryMatcher, one regex per key.'''
+    tags = set()
+    for cat in categories:
+        lc_cat = cat.lower()
+        for key, value in cat_to_entity.items():
+            if not matcher.get_pattern(key).search(lc_cat):
+                continue
+            exclude = value.get('exclude_cats')
+            if exclude:
+                pattern = re.compile(r'\b(' + '|'.join(re.escape(e) for e in exclude) + r')\b', re.I)
+                if pattern.search(lc_cat):
+                    continue
+            tags |= set(value['tags'])
+    return sorted(tags)
+
+def random_categories(cat_to_entity, count):
+    words = sorted({word for key in cat_to_entity for word in key.split()})
+    words += sorted({e for t in cat_to_entity.values() for e in t.get('exclude_cats', [])})
+    words += ['in', 'of', 'the', 'Former', 'Demolished', 'bus-stations', 'railway-']
+    rand = random.Random(0)
+    for num in range(count):
+        cat = ' '.join(rand.choice(words) for i in range(rand.randint(1, 6)))
+        yield cat.title() if rand.random() < 0.5 else cat
+
+def test_category_matcher_matches_regex():
+    cat_to_entity = matcher.build_cat_map(load_entity_types())
+    categories = list(random_categories(cat_to_entity, 2000))
+    categories += [key.title() for key in cat_to_entity]
+    categories += ['Railway stations in France', 'Bus stations', 'Stationsfoo in Bar',
+                   'Museums established in 1900', '']
+
+    for cat in categories:
+        expect = old_categories_to_tags([cat], cat_to_entity)
+        assert matcher.categories_to_tags([cat], cat_to_entity) == expect, cat
+
+def old_endings_and_max_dist(entity_types, tags):
+    '''get_ending_from_criteria and get_max_dist_from_criteria before
+    EntityTypeIndex, a scan over every entity type.'''
+    tags = set(tags)
+    endings = set()
+    max_dists = []
+    for t in entity_types:
+        if tags & set(t['tags']):
+            endings.update(t.get('trim', []))
+            if t.get('max_dist'):
+                max_dists.append(t['max_dist'])
+    return endings, (max(max_dists) if max_dists else None)
+
+def test_entity_type_index_matches_scan():
+    entity_types = load_entity_types()
+    entity_types[0]['max_dist'] = 10  # the data file has no max_dist values
+    index = matcher.EntityTypeIndex(entity_types)
+
+    all_tags = sorted({tag for t in entity_types for tag in t['tags']})
+    rand = random.Random(0)
+    tag_lists = [[tag] for tag in all_tags] + [rand.sample(all_tags, 3) for num in range(200)]
+    tag_lists.append(['no_such_tag'])
+    for tags in tag_lists:
+        expect = old_endings_and_max_dist(entity_types, tags)
+        assert (index.endings(tags), index.max_dist(tags)) == expect, tags
+
+def test_entity_type_index_reload_check(monkeypatch, tmpdir):
+    filename = str(tmpdir.join('entity_types.json'))
+    open(filename, 'w').write('[]')
+    clock = [1000.0]
+    stat_calls = []
+    real_stat = os.stat
+    def fake_stat(path):
+        stat_calls.append(path)
+        return real_stat(path)
+
+    monkeypatch.setattr(matcher, 'time', lambda: clock[0])
+    index = matcher.EntityTypeIndex.load(filename)
+    monkeypatch.setattr(matcher.os, 'stat', fake_stat)
+
+    for num in range(100):
+        assert index.is_current(filename)
+    assert stat_calls == []
+
+    os.utime(filename, (0, 0))
+    clock[0] += matcher.entity_types_check_interval
+    assert not index.is_current(filename)
+    assert len(stat_calls) == 1
+
+class FakeItem:
+    def __init__(self, item_id, names, tags, categories=None):
+        self.item_id = item_id
+        self.entity = {}
+        self.tags = tags
+        self.categories = categories
+        self._names = names
+
+    def names(self):
+        return {name: [('label', 'en')] for name in self._names}
+
+def name_match_fixture():
+    item_rows = []
+    for num in range(1, 12):
+        item = FakeItem(num, ['Village {} Station'.format(num), 'Village {}'.format(num)],
+                        {'railway=station'})
+        rows = [
+            ('point', num * 10, 'Village {}'.format(num),
+             {'name': 'Village {}'.format(num), 'railway': 'station'}, 5.0),
+            ('point', num * 10, 'duplicate row', {'name': 'Village {}'.format(num)}, 6.0),
+            ('line', num * 10 + 1, 'Other Road', {'name': 'Other Road'}, 7.0),
+            ('polygon', -(num * 10 + 2), 'Village {} Station'.format(num),
+             {'name': 'Village {} Station'.format(num)}, 8.0),
+            ('point', num * 10 + 3, None, {'railway': 'station'}, 9.0),
+            ('point', num * 10 + 4, 'Townland', {'name': 'Village {}'.format(num),
+                                                 'locality': 'townland'}, 10.0),
+        ]
+        item_rows.append((item, rows))
+    item_rows.append((FakeItem(99, ['Nowhere'], {'railway=station'}), []))
+    return item_rows
+
+def test_parallel_item_matches_same_as_serial(monkeypatch):
+    monkeypatch.setattr(matcher, 'get_ending_from_criteria', lambda tags: {'station'})
+    item_rows = name_match_fixture()
+
+    serial = [(item.item_id, matcher.check_item_candidates(item, rows))
+              for item, rows in item_rows]
+    assert sum(len(candidates) for item_id, candidates in serial) == 22
+
+    for workers in 1, 3:
+        parallel = [(item.item_id, candidates) for item, candidates
+                    in matcher.parallel_item_matches(iter(item_rows), workers, batch_size=2)]
+        assert parallel == serial
+
+def test_item_query_sql_casts_placeholders():
+    placeholders = {p: '%({})s'.format(p) for p in matcher.item_query_params}
+    sql = matcher.item_query_sql('osm_1', placeholders)
+    # an empty list is sent as '{}', unnest needs the type
+    assert 'unnest(%(tag_pair_keys)s::text[], %(tag_pair_values)s::text[])' in sql
+    assert 'tags ?| %(tag_keys)s::text[]' in sql
+    assert '%(max_dist)s::float * 1000' in sql
+    assert placeholders['max_dist'] == '%(max_dist)s'
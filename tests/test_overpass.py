@@ -1,4 +1,8 @@
-from matcher.overpass import oql_from_tag, oql_for_area, group_tags
+from matcher.overpass import oql_from_tag, oql_for_area, group_tags, OverpassCache
+from matcher import overpass, utils
+import pytest
+from lxml import etree
+import os
 from pprint import pprint
 
 tags = ['admin_level', 'amenity=arts_centre',
@@ -102,3 +106,171 @@ def test_group_tags():
     }
 
     assert ret == expect
+
+def test_overpass_cache(tmp_path):
+    cache = OverpassCache(str(tmp_path), max_size=10000, ttl=60)
+    oql = '[out:json];\n  node(1);\nout;'
+    assert cache.get(oql) is None
+
+    cache.set(oql, b'{"elements": []}')
+    assert cache.get(oql) == b'{"elements": []}'
+    # indentation and blank lines don't change the key
+    assert cache.get('\n[out:json];\nnode(1);\n\nout;\n') == b'{"elements": []}'
+
+    cache.set('node(2);out;', b'expired', ttl=-1)
+    assert cache.get('node(2);out;') is None
+    assert len(list(tmp_path.iterdir())) == 1
+
+def test_overpass_cache_eviction(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, 'evict_interval', 0)
+    cache = OverpassCache(str(tmp_path), ttl=60)
+    content = os.urandom(500)  # doesn't compress
+    cache.set('node(0);out;', content)
+    cache.max_size = cache.size() * 3 + 100
+
+    for num in range(3):
+        oql = 'node({});out;'.format(num)
+        cache.set(oql, content)
+        os.utime(cache.filename(oql), (num, num))
+    assert cache.get('node(0);out;') == content  # now the most recently used
+
+    cache.set('node(3);out;', content)
+    assert cache.size() <= cache.max_size
+    assert cache.get('node(0);out;') == content
+    assert cache.get('node(1);out;') is None
+    assert cache.get('node(3);out;') == content
+
+def test_overpass_cache_evict_interval(tmp_path, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(utils, 'time', lambda: clock[0])
+    monkeypatch.setattr(utils, 'last_evict', {})
+    scans = []
+    monkeypatch.setattr(OverpassCache, 'evict', lambda self: scans.append(clock[0]))
+    cache = OverpassCache(str(tmp_path), ttl=60)
+
+    for num in range(10):
+        cache.set('node({});out;'.format(num), b'x')
+    assert scans == [1000.0]
+
+    clock[0] += utils.evict_interval
+    cache.set('node(10);out;', b'x')
+    assert len(scans) == 2
+
+def test_overpass_cache_evicted_during_get(tmp_path, monkeypatch):
+    cache = OverpassCache(str(tmp_path), ttl=60)
+    cache.set('node(1);out;', b'x')
+
+    def utime(filename):
+        raise FileNotFoundError(filename)
+    monkeypatch.setattr(overpass.os, 'utime', utime)
+    assert cache.get('node(1);out;') is None
+
+class FakeReply:
+    def __init__(self, content, status_code=200):
+        self.content = content
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        assert self.status_code == 200
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+def test_run_chunk_queries(tmp_path, monkeypatch):
+    calls = []
+
+    def run_query(oql, stream=False):
+        calls.append(oql)
+        if oql == 'timeout' and calls.count(oql) == 1:
+            return FakeReply(b'<remark> runtime error: Query timed out </remark>')
+        if oql == 'memory':
+            return FakeReply(b'<remark> runtime error: Query run out of memory </remark>')
+        return FakeReply(oql.encode('utf-8'))
+
+    status = {'rate_limit': 2, 'slots': [], 'free': 2, 'running': 0}
+    monkeypatch.setattr(overpass, 'run_query', run_query)
+    monkeypatch.setattr(overpass, 'get_status', lambda: status)
+
+    queries = [(oql, str(tmp_path / (oql + '.xml'))) for oql in ('a', 'timeout', 'b', 'memory')]
+    failed = overpass.run_chunk_queries(queries)
+
+    assert [(oql, type(error)) for oql, _, error in failed] == [('memory', overpass.OutOfMemory)]
+    assert calls.count('timeout') == 2
+    assert calls.count('memory') == 1
+    assert sorted(f.name for f in tmp_path.iterdir()) == ['a.xml', 'b.xml', 'timeout.xml']
+    assert (tmp_path / 'timeout.xml').read_bytes() == b'timeout'
+
+def test_run_chunk_queries_no_free_slot(tmp_path, monkeypatch):
+    # other clients hold every slot, the status doesn't say when one is free
+    busy = {'rate_limit': 2, 'slots': [], 'free': 0, 'running': 2}
+    statuses = [busy, busy, busy, {'rate_limit': 2, 'slots': [], 'free': 2, 'running': 0}]
+    waits = []
+    monkeypatch.setattr(overpass, 'get_status', lambda: statuses.pop(0))
+    monkeypatch.setattr(overpass, 'sleep', waits.append)
+    monkeypatch.setattr(overpass, 'run_query', lambda oql, stream=False: FakeReply(b'ok'))
+
+    failed = overpass.run_chunk_queries([('a', str(tmp_path / 'a.xml'))])
+    assert failed == []
+    assert waits == [5, 10, 20]
+    assert statuses == []
+
+def test_save_stream(tmp_path):
+    filename = str(tmp_path / 'reply.xml')
+    overpass.save_stream([b'<osm>', b'</osm>'], filename, check=overpass.check_start)
+    assert open(filename, 'rb').read() == b'<osm></osm>'
+
+    error = [b'<osm><remark> runtime error: Query timed out', b'</remark></osm>']
+    with pytest.raises(overpass.Timeout):
+        overpass.save_stream(error, str(tmp_path / 'error.xml'), check=overpass.check_start)
+    assert sorted(f.name for f in tmp_path.iterdir()) == ['reply.xml']
+
+def test_save_stream_open_fails(tmp_path, monkeypatch):
+    def fail_open(filename, mode):
+        raise PermissionError(filename)
+    monkeypatch.setattr(overpass, 'open', fail_open, raising=False)
+
+    with pytest.raises(PermissionError):  # not hidden by a failed remove
+        overpass.save_stream([b'<osm></osm>'], str(tmp_path / 'reply.xml'))
+
+def test_query_error_mail(monkeypatch):
+    sent = []
+    monkeypatch.setattr(overpass.mail, 'send_mail', lambda subject, body: sent.append((subject, body)))
+    error = overpass.Timeout(b'<remark> runtime error: Query timed out</remark>')
+    overpass.query_error_mail('node(1);out;', error)
+
+    subject, body = sent[0]
+    assert subject == 'overpass timeout'
+    assert 'node(1);out;' in body and 'Query timed out' in body
+
+def test_merge_osm_files(tmp_path):
+    chunk1 = '''<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6" generator="Overpass API">
+<note>note</note>
+  <node id="1" lat="1.0" lon="1.0"/>
+  <node id="2" lat="2.0" lon="2.0"/>
+  <way id="10"><nd ref="1"/><nd ref="2"/><tag k="name" v="A"/></way>
+</osm>'''
+    chunk2 = '''<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6" generator="Overpass API">
+  <node id="2" lat="2.0" lon="2.0"/>
+  <node id="3" lat="3.0" lon="3.0"/>
+  <way id="10"><nd ref="1"/><nd ref="2"/><tag k="name" v="A"/></way>
+  <relation id="5"><member type="way" ref="10" role="outer"/></relation>
+</osm>'''
+    filenames = []
+    for num, xml in enumerate([chunk1, chunk2]):
+        filename = tmp_path / 'chunk{}.xml'.format(num)
+        filename.write_text(xml)
+        filenames.append(str(filename))
+
+    out = str(tmp_path / 'merged.xml')
+    assert overpass.merge_osm_files(filenames, out) == (5, 2)
+
+    root = etree.parse(out).getroot()
+    assert [(e.tag, e.get('id')) for e in root] == [
+        ('node', '1'), ('node', '2'), ('node', '3'), ('way', '10'), ('relation', '5')]
+    assert root[3].find('tag').get('v') == 'A'
@@ -1,6 +1,6 @@
 from matcher.model import Item
 from matcher.place import Place
-from matcher import database
+from matcher import database, matcher, place
 
 def simple_place():
     place = Place(place_id=1,
@@ -52,3 +52,47 @@ def test_place_country_code(app):
                      'country_code': 'us'}
     assert place.country_code == 'us'
     assert place.get_address_key('missing key') is None
+
+def test_chunk_cells(app, monkeypatch):
+    place = simple_place()
+    place.place_id = place.osm_id = 2
+    (place.south, place.north, place.west, place.east) = (51.0, 52.0, -3.0, -2.0)
+    item_tags = [{'amenity=library'}, {'tourism=museum', 'building'}, set()]
+    for num, tags in enumerate(item_tags, 1):
+        item = Item(item_id=100 + num,
+                    tags=tags,
+                    location='Point(-2.{0} 51.{0})'.format(num))
+        place.items.append(item)
+    database.session.add(place)
+    database.session.commit()
+
+    cells = place.chunk_cells()
+    assert len(cells) == 1
+    path, bbox, points = cells[0]
+    assert bbox == place.bbox
+    assert sorted((round(lat, 1), round(lon, 1), tags) for lat, lon, tags in points) == [
+        (51.1, -2.1, {'amenity=library'}),
+        (51.2, -2.2, {'tourism=museum', 'building'}),
+        (51.3, -2.3, set()),
+    ]
+
+    monkeypatch.setitem(app.config, 'CHUNK_MAX_ITEMS', 1)
+    cells = place.chunk_cells()
+    assert len(cells) == 3
+    assert all(len(points) == 1 for path, bbox, points in cells)
+
+def test_chunk_query_includes_neighbours(monkeypatch):
+    monkeypatch.setattr(matcher, 'get_max_dist_from_criteria',
+                        lambda tags: 10 if 'aeroway=aerodrome' in tags else None)
+    # two chunks split at longitude 0, the airport is in the east chunk but
+    # close enough to the border to match an object in the west chunk
+    west = (51.0, 52.0, -1.0, 0.0)
+    points = [(51.5, -0.5, {'amenity=pub'}),
+              (51.5, 0.01, {'aeroway=aerodrome'}),
+              (51.5, 0.5, {'historic=castle'})]
+
+    margin = place.chunk_margin(points)
+    assert 0.089 < margin < 0.09  # 10 km in EPSG:3857 units
+    query_bbox, tags = place.chunk_query(west, points, margin)
+    assert query_bbox == (51.0 - margin, 52.0 + margin, -1.0 - margin, margin)
+    assert set(tags) == {'amenity=pub', 'aeroway=aerodrome'}
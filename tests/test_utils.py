@@ -0,0 +1,54 @@
+from matcher import utils
+
+def test_haversine_distances(monkeypatch):
+    london, paris = (51.5074, -0.1278), (48.8566, 2.3522)
+    points = [london, paris, (51.5080, -0.1281)]
+
+    distances = utils.haversine_distances(*london, points)
+    assert distances[0] == 0
+    assert 343000 < distances[1] < 344000
+    assert 60 < distances[2] < 80
+
+    monkeypatch.setattr(utils, 'numpy', None)
+    fallback = utils.haversine_distances(*london, points)
+    assert [round(d, 3) for d in fallback] == [round(d, 3) for d in distances]
+
+    assert utils.haversine_distances(*london, []) == []
+
+def test_element_coords():
+    node = {'type': 'node', 'lat': 1.5, 'lon': 2.5}
+    way = {'type': 'way', 'center': {'lat': 3.5, 'lon': 4.5}}
+    assert utils.element_coords(node) == (1.5, 2.5)
+    assert utils.element_coords(way) == (3.5, 4.5)
+
+def test_quadtree_chunks():
+    bbox = (52.0, 52.4, 0.0, 0.4)
+    town = [(52.05 + n * 0.0001, 0.05, 'town') for n in range(20)]
+    village = [(52.35, 0.35, 'village')]
+    cells = utils.quadtree_chunks(bbox, town + village, max_points=5, max_area=10000)
+
+    assert sum(len(points) for _, _, points in cells) == 21
+    assert all(len(points) <= 5 for path, _, points in cells if len(path) < 8)
+    # the village gets one big cell, the empty quarters are skipped
+    assert ('3', (52.2, 52.4, 0.2, 0.4), village) in cells
+    assert not any(path.startswith(('1', '2')) for path, _, _ in cells)
+
+    assert utils.quadtree_chunks(bbox, [], 5, 10000) == []
+    assert [path for path, _, _ in utils.quadtree_chunks(bbox, village, 5, 200)] == ['33']
+
+def test_split_cell():
+    cell = ('', (0.0, 2.0, 0.0, 2.0), [(0.5, 0.5), (1.5, 1.5), (1.0, 1.0)])
+    assert utils.split_cell(cell) == [
+        ('0', (0.0, 1.0, 0.0, 1.0), [(0.5, 0.5)]),
+        ('3', (1.0, 2.0, 1.0, 2.0), [(1.5, 1.5), (1.0, 1.0)]),
+    ]
+
+def test_bbox_tiles():
+    bbox = (52.0, 52.8, 0.0, 1.2)
+    assert utils.bbox_tiles(bbox, 10000) == [bbox]
+
+    tiles = utils.bbox_tiles(bbox, 1000)
+    assert len(tiles) == 16
+    assert all(utils.bbox_area_in_sq_km(tile) <= 1000 for tile in tiles)
+    total = sum(utils.bbox_area_in_sq_km(tile) for tile in tiles)
+    assert abs(total - utils.bbox_area_in_sq_km(bbox)) < 0.001
@@ -1,5 +1,7 @@
-from matcher import wikidata, place
+from matcher import wikidata, place, utils
 import pytest
+import json
+import os
 import vcr
 
 test_entity = {
@@ -361,3 +363,272 @@ def test_names_from_entity():
     }
 
     assert dict(names) == expect
+
+@pytest.fixture
+def wikidata_api(api_session):
+    '''Wikidata API where every item exists, at revision lastrevid.'''
+    api_session.lastrevid = 1
+
+    def reply(params):
+        if params['action'] == 'query':
+            pages = [{'title': qid, 'lastrevid': api_session.lastrevid}
+                     for qid in params['titles'].split('|')]
+            return {'query': {'pages': pages}}
+        entities = {qid: {'id': qid, 'lastrevid': api_session.lastrevid}
+                    for qid in params['ids'].split('|')}
+        return {'entities': entities}
+
+    api_session.reply = reply
+    return api_session
+
+def test_api_get_maxlag(wikidata_api, monkeypatch):
+    wikidata_api.queue({'error': {'code': 'maxlag'}}, headers={'Retry-After': '1'})
+    wikidata_api.queue({}, status_code=429, headers={'Retry-After': '2'})
+    waits = []
+    monkeypatch.setattr(wikidata, 'sleep', waits.append)
+
+    json_data = wikidata.api_get({'action': 'wbgetentities', 'ids': 'Q1'})
+    assert json_data == {'entities': {'Q1': {'id': 'Q1', 'lastrevid': 1}}}
+    assert waits == [1, 2]
+    assert all(call['maxlag'] == wikidata.maxlag for call in wikidata_api.calls)
+
+def test_entity_iter_order(wikidata_api, tmpdir):
+    ids = ['Q{}'.format(num) for num in range(1, 230)]
+
+    store = wikidata.EntityStore(str(tmpdir.join('four')))
+    assert [qid for qid, entity in wikidata.entity_iter(ids, 4, store)] == ids
+    store = wikidata.EntityStore(str(tmpdir.join('one')))
+    assert [qid for qid, entity in wikidata.entity_iter(ids, 1, store)] == ids
+
+def test_entity_iter_streams(wikidata_api, tmpdir):
+    ids = ['Q{}'.format(num) for num in range(1, 230)]
+
+    store = wikidata.EntityStore(str(tmpdir))
+    for qid in ids[-10:]:
+        store.save(qid, {'id': qid, 'lastrevid': 1})
+    wikidata_api.calls = []
+
+    found = wikidata.entity_iter(ids, 1, store)
+    assert [next(found)[0] for num in range(10)] == ids[-10:]  # stored entities first
+    assert wikidata_api.calls == []
+    assert next(found)[0] == 'Q1'
+    assert len(wikidata_api.calls) == 1  # one batch downloaded, not all of them
+    assert [qid for qid, entity in found] == ids[1:-10]
+    assert len(wikidata_api.calls) == 5
+
+def test_entity_store_eviction(monkeypatch, tmpdir):
+    monkeypatch.setattr(utils, 'evict_interval', 0)
+    store = wikidata.EntityStore(str(tmpdir))
+    for num in range(3):
+        store.save('Q{}'.format(num), {'id': 'Q{}'.format(num), 'lastrevid': 1})
+        os.utime(store.filename('Q{}'.format(num)), (num, num))
+
+    store.max_size = store.size() + store.size() // 6  # room for three and a half
+    store.save('Q3', {'id': 'Q3', 'lastrevid': 1})
+    assert store.load('Q0') is None
+    assert all(store.load('Q{}'.format(num)) for num in range(1, 4))
+    assert store.size() <= store.max_size
+
+def test_entity_store_revalidate(wikidata_api, tmpdir):
+    store = wikidata.EntityStore(str(tmpdir), max_age=3600)
+    ids = ['Q1', 'Q2']
+
+    store.get_entities(ids, concurrency=1)
+    assert [call['action'] for call in wikidata_api.calls] == ['wbgetentities']
+
+    # fresh entries are used without asking the API
+    assert store.get_entities(ids, concurrency=1)['Q2']['lastrevid'] == 1
+    assert len(wikidata_api.calls) == 1
+
+    # old entries with an unchanged revision only need a revision check
+    store.max_age = 0
+    store.get_entities(ids, concurrency=1)
+    assert [call['action'] for call in wikidata_api.calls[1:]] == ['query']
+
+    # once the item is edited the entity is downloaded again
+    wikidata_api.lastrevid = 2
+    entities = store.get_entities(ids, concurrency=1)
+    assert [call['action'] for call in wikidata_api.calls[2:]] == ['query', 'wbgetentities']
+    assert wikidata_api.calls[-1]['ids'] == 'Q1|Q2'
+    assert entities['Q1']['lastrevid'] == 2
+    assert store.load('Q1')['lastrevid'] == 2
+
+def test_get_entity_revalidates(wikidata_api, monkeypatch, tmpdir):
+    from flask import Flask
+    app = Flask(__name__)
+    app.config['CACHE_DIR'] = str(tmpdir)
+
+    clock = [1000.0]
+    monkeypatch.setattr(wikidata, 'time', lambda: clock[0])
+    with app.app_context():
+        assert wikidata.get_entity('Q1')['lastrevid'] == 1
+        os.utime(wikidata.get_entity_store().filename('Q1'), (clock[0], clock[0]))
+        assert wikidata.get_entity('Q1')['lastrevid'] == 1
+        assert len(wikidata_api.calls) == 1
+
+        # well inside the day the store trusts entries for other callers
+        wikidata_api.lastrevid = 2
+        clock[0] += wikidata.interactive_entity_max_age
+        assert wikidata.get_entity('Q1')['lastrevid'] == 2
+        assert [call['action'] for call in wikidata_api.calls[1:]] == ['query', 'wbgetentities']
+
+def test_location_labels_cache(monkeypatch):
+    requested = []
+    def fake_entity_iter(ids):
+        requested.append(list(ids))
+        for qid in ids:
+            yield qid, {'labels': {'en': {'language': 'en', 'value': 'Name ' + qid}}}
+
+    monkeypatch.setattr(wikidata, 'entity_iter', fake_entity_iter)
+    monkeypatch.setattr(wikidata, 'location_cache', {})
+    entity = {'claims': {'P131': [{'mainsnak': {'datavalue': {'value': {'id': qid}}}}
+                                  for qid in ('Q1', 'Q2', 'Q1')]}}
+
+    assert wikidata.location_labels(wikidata.located_in(entity)) == {'Q1': {'Name Q1'},
+                                                                     'Q2': {'Name Q2'}}
+    assert wikidata.location_labels(['Q2', 'Q3']) == {'Q2': {'Name Q2'},
+                                                      'Q3': {'Name Q3'}}
+    assert requested == [['Q1', 'Q2'], ['Q3']]
+
+    item = wikidata.WikidataItem('Q10', entity)
+    names = {'Name Q1 Station': [('label', 'en')]}
+    item.trim_location_from_names(names)
+    assert 'Station' in names
+    assert len(requested) == 2
+
+def test_parse_combined_query():
+    def row(qid, tags, article=None):
+        r = {'place': {'value': wikidata.wd_entity + qid[1:]},
+             'placeLabel': {'value': 'label ' + qid},
+             'location': {'value': 'Point(0 0)'},
+             'tags': {'value': '|'.join(tags)}}
+        if article:
+            r['article'] = {'value': wikidata.enwiki + article}
+        return r
+
+    rows = [row('Q1', ['Tag:amenity=school', 'Key:building', 'Key:website'], 'Some_School'),
+            row('Q2', [], 'Some_Park'),
+            row('Q3', ['Key:highway', 'Tag:highway=road']),
+            row('Q4', ['Tag:historic=castle'])]
+    items = wikidata.parse_combined_query(rows)
+
+    assert set(items) == {'Q1', 'Q2', 'Q4'}
+    assert items['Q1']['tags'] == {'amenity=school', 'building'}
+    assert items['Q1']['enwiki'] == 'Some School'
+    assert items['Q2']['tags'] == set()
+    assert 'enwiki' not in items['Q4']
+
+def test_get_items_tiled(monkeypatch):
+    from flask import Flask
+    from matcher import utils
+
+    def fake_items_from_queries(queries, combined, send_mail=True):
+        tile = queries[0]
+        if utils.bbox_area_in_sq_km(tile) > 2000:
+            raise wikidata.QueryTimeout(tile, None)
+        south, north, west, east = tile
+        # Q1 is on the corner shared by every tile
+        return {'Q1': {'tags': {'south={}'.format(south)}},
+                'Q{}_{}'.format(south, west): {'tags': set()}}
+
+    monkeypatch.setattr(wikidata, 'bbox_queries', lambda bbox, combined: [bbox])
+    monkeypatch.setattr(wikidata, 'items_from_queries', fake_items_from_queries)
+    bbox = (52.0, 52.8, 0.0, 1.2)
+    with Flask(__name__).app_context():
+        items = wikidata.get_items_tiled(bbox, 10000, combined=True)
+
+    # one timeout, then four tiles that each return one item and Q1
+    assert len(items) == 5
+    assert items['Q1']['tags'] == {'south=52.0', 'south=52.4'}
+
+class FailedQueryReply:
+    status_code = 500
+    text = 'java.lang.IllegalStateException'
+
+def test_get_items_tiled_error_mail(monkeypatch):
+    from flask import Flask
+    import threading
+
+    def fake_items_from_queries(queries, combined, send_mail=True):
+        wikidata.check_query_reply(queries[0], FailedQueryReply(), send_mail)
+
+    mailed = []
+    def error_mail(subject, query, r, reply=None):
+        mailed.append((query, threading.current_thread()))
+
+    monkeypatch.setattr(wikidata, 'bbox_queries', lambda bbox, combined: [bbox])
+    monkeypatch.setattr(wikidata, 'items_from_queries', fake_items_from_queries)
+    monkeypatch.setattr(wikidata.mail, 'error_mail', error_mail)
+    bbox = (52.0, 52.8, 0.0, 1.2)
+    with Flask(__name__).app_context():
+        with pytest.raises(wikidata.QueryError):
+            wikidata.get_items_tiled(bbox, 10000, combined=True)
+
+    # only the main thread sends mail, once for the failed tile
+    assert len(mailed) == 1
+    assert mailed[0][1] is threading.current_thread()
+
+class StreamedReply:
+    status_code = 200
+
+    def __init__(self, text):
+        self.text = text
+
+    def iter_content(self, chunk_size):
+        data = self.text.encode('utf-8')
+        for start in range(0, len(data), chunk_size):
+            yield data[start:start + chunk_size]
+
+def sparql_reply(rows, truncated=False):
+    text = json.dumps({'head': {'vars': []}, 'results': {'bindings': rows}})
+    if truncated:  # how WDQS ends a reply when the query times out
+        text = text[:len(text) // 2] + '\njava.util.concurrent.TimeoutException\n'
+    return StreamedReply(text)
+
+def test_run_query_stream_truncated(monkeypatch):
+    rows = [{'place': {'value': wikidata.wd_entity + str(num)}} for num in range(100)]
+    reply = sparql_reply(rows, truncated=True)
+    monkeypatch.setattr(wikidata.requests, 'get', lambda *args, **kwargs: reply)
+
+    with pytest.raises(wikidata.QueryTimeout) as e:
+        list(wikidata.run_query_stream('query', send_mail=False))
+    assert 'TimeoutException' in e.value.reply
+
+def test_get_items_tiled_truncated(monkeypatch):
+    from flask import Flask
+
+    def fake_get(url, params=None, **kwargs):
+        tile = params['query']
+        if utils.bbox_area_in_sq_km(tile) > 2000:
+            return sparql_reply([{}] * 10, truncated=True)
+        south, north, west, east = tile
+        return sparql_reply([{'place': {'value': wikidata.wd_entity + str(int(west * 10))},
+                              'placeLabel': {'value': 'tile'},
+                              'location': {'value': 'Point(0 0)'},
+                              'tags': {'value': 'Tag:amenity=school'}}])
+
+    monkeypatch.setattr(wikidata, 'bbox_queries', lambda bbox, combined: [bbox])
+    monkeypatch.setattr(wikidata.requests, 'get', fake_get)
+    bbox = (52.0, 52.8, 0.0, 1.2)
+    with Flask(__name__).app_context():
+        items = wikidata.get_items_tiled(bbox, 10000, combined=True)
+
+    # the truncated reply was treated as a timeout and the tile split
+    assert set(items) == {'Q0', 'Q6'}
+
+def test_iter_bindings():
+    rows = [{'place': {'type': 'uri', 'value': wikidata.wd_entity + str(num)},
+             'placeLabel': {'type': 'literal', 'value': 'Zürich [{}], "{}"'.format(num, num)}}
+            for num in range(50)]
+    doc = json.dumps({'head': {'vars': ['place', 'placeLabel']},
+                      'results': {'bindings': rows}}, indent=2)
+
+    for size in 1, 7, 1000, len(doc):
+        chunks = [doc[i:i + size] for i in range(0, len(doc), size)]
+        assert list(wikidata.iter_bindings(chunks)) == rows
+
+    empty = json.dumps({'head': {'vars': []}, 'results': {'bindings': []}})
+    assert list(wikidata.iter_bindings([empty])) == []
+
+    with pytest.raises(ValueError):
+        list(wikidata.iter_bindings([doc[:len(doc) // 2]]))
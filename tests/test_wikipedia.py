@@ -1,5 +1,66 @@
 from matcher import wikipedia
+import threading
+import pytest
 
 def test_name_from_html():
     sample = '''<div class="mw-parser-output"><div class="thumb tright"> <div class="thumbinner" style="width:252px;"><a href="/wiki/File:Isaac_Newton_Institute_building.jpg" class="image"><img alt="" src="//upload.wikimedia.org/wikipedia/commons/thumb/1/14/Isaac_Newton_Institute_building.jpg/250px-Isaac_Newton_Institute_building.jpg" width="250" height="139" class="thumbimage" srcset="//upload.wikimedia.org/wikipedia/commons/thumb/1/14/Isaac_Newton_Institute_building.jpg/375px-Isaac_Newton_Institute_building.jpg 1.5x, //upload.wikimedia.org/wikipedia/commons/thumb/1/14/Isaac_Newton_Institute_building.jpg/500px-Isaac_Newton_Institute_building.jpg 2x" data-file-width="1184" data-file-height="660" /></a> <div class="thumbcaption"> <div class="magnify"><a href="/wiki/File:Isaac_Newton_Institute_building.jpg" class="internal" title="Enlarge"></a></div> Main building for the Isaac Newton Institute</div> </div> </div> <p><b>The Isaac Newton Institute for Mathematical Sciences</b> is an international research institute for mathematics and its many applications at the <a href="/wiki/University_of_Cambridge" title="University of Cambridge">University of Cambridge</a>. It is named after one of the university's most illustrious figures, the mathematician and natural philosopher <a href="/wiki/Sir_Isaac_Newton" class="mw-redirect" title="Sir Isaac Newton">Sir Isaac Newton</a> and occupies buildings adjacent to the Cambridge <a href="/wiki/Centre_for_Mathematical_Sciences_(Cambridge)" title="Centre for Mathematical Sciences (Cambridge)">Centre for Mathematical Sciences</a>.</p>'''
     assert wikipedia.html_names(sample) == ['The Isaac Newton Institute for Mathematical Sciences']
+
+def test_page_category_iter_continue(api_session):
+    def reply(params):
+        # one category per request, with a continue token until every
+        # category for the batch has been sent
+        offset = int(params.get('clcontinue', 0))
+        pages = [{'title': title,
+                  'categories': [{'title': 'Category:{} {}'.format(title, offset)}]}
+                 for title in params['titles'].split('|')]
+        json_data = {'query': {'pages': pages}}
+        if offset + 1 < 3:
+            json_data['continue'] = {'clcontinue': str(offset + 1), 'continue': '||'}
+        return json_data
+
+    api_session.reply = reply
+    titles = ['Page {}'.format(num) for num in range(120)]
+
+    cats = dict(wikipedia.page_category_iter(titles, concurrency=4))
+    assert set(cats) == set(titles)
+    assert cats['Page 7'] == ['Page 7 0', 'Page 7 1', 'Page 7 2']
+    assert len(api_session.calls) == 3 * 3  # three batches, three requests each
+
+def test_batch_iter_error_mail_from_caller(api_session, monkeypatch):
+    api_session.reply = lambda params: {}
+    api_session.status_code = 500
+    mailed = []
+    def error_mail(subject, data, r):
+        mailed.append(threading.current_thread())
+    monkeypatch.setattr(wikipedia.mail, 'error_mail', error_mail)
+    titles = ['Page {}'.format(num) for num in range(120)]
+
+    with pytest.raises(wikipedia.QueryError):
+        list(wikipedia.page_category_iter(titles, concurrency=4))
+    assert mailed == [threading.current_thread()]
+
+def page_reply(params):
+    pages = []
+    for title in params['titles'].split('|'):
+        if title == 'Missing':
+            pages.append({'title': title, 'missing': True})
+        elif params['prop'] == 'extracts':
+            pages.append({'title': title, 'extract': '<p><b>{}</b></p>'.format(title)})
+        else:
+            page = {'title': title, 'lastrevid': 10}
+            if title != 'Redirect':
+                page['categories'] = [{'title': 'Category:Towers'}]
+            pages.append(page)
+    return {'query': {'pages': pages}}
+
+def test_fetch_pages(api_session):
+    api_session.reply = page_reply
+    pages = wikipedia.fetch_pages(['Eiffel Tower', 'Redirect', 'Missing'], concurrency=1)
+
+    assert set(pages) == {'Eiffel Tower', 'Redirect'}
+    assert pages['Eiffel Tower'] == {'lastrevid': 10,
+                                     'categories': ['Towers'],
+                                     'extract': '<p><b>Eiffel Tower</b></p>'}
+    assert pages['Redirect']['categories'] is None
+    assert wikipedia.latest_revisions(['Eiffel Tower', 'Missing'], concurrency=1) == {'Eiffel Tower': 10}